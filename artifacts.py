@@ -0,0 +1,131 @@
+"""
+Module is used to keep intermediate results of the pipeline on disk.
+Frames are written to Parquet files. Every file is written to a temporary path first and then renamed, so a file
+is either complete or missing. Manifest keeps the list of completed stages and their artifacts.
+Frames are not kept in memory between stages: every stage reads only the artifacts it uses, when it uses them,
+so wide columns needed by one stage (e.g. event descriptions) do not stay in memory for the whole run.
+"""
+
+from compact_frames import get_memory_usage, restore_compact
+from collections.abc import Mapping
+from typing import Iterator, Optional
+import pandas as pd
+import datetime
+import json
+import os
+
+MANIFEST = 'manifest.json'
+
+
+def write_frame(df: pd.DataFrame, path: str) -> int:
+    """Writes df to Parquet file atomically. Returns size of the file in bytes"""
+    df.to_parquet(path + '.tmp', index=not isinstance(df.index, pd.RangeIndex) or df.index.name is not None)
+    os.replace(path + '.tmp', path)
+    return os.path.getsize(path)
+
+
+def read_frame(path: str) -> pd.DataFrame:
+    """Reads df written with write_frame. Compact dtypes are restored (see compact_frames)"""
+    return restore_compact(pd.read_parquet(path))
+
+
+def write_json(data: dict, path: str) -> None:
+    """Writes data to JSON file atomically"""
+    with open(path + '.tmp', 'w') as output:
+        json.dump(data, output, indent=2, default=str)
+    os.replace(path + '.tmp', path)
+
+
+class StageArtifacts(Mapping):
+    """Artifacts of a completed stage by name. Every frame is read on first access"""
+
+    def __init__(self, store, stage: str):
+        self.store = store
+        self.stage = stage
+        self.frames = {}
+
+    def __getitem__(self, name: str) -> pd.DataFrame:
+        if name not in self.frames:
+            if name not in self.store.manifest['stages'][self.stage]['artifacts']:
+                raise KeyError(name)
+            self.frames[name] = read_frame(self.store.get_path(self.stage, name))
+        return self.frames[name]
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.store.manifest['stages'][self.stage]['artifacts'])
+
+    def __len__(self) -> int:
+        return len(self.store.manifest['stages'][self.stage]['artifacts'])
+
+
+class ArtifactStore:
+    """
+    Directory with artifacts of pipeline stages. Artifacts of a stage are frames saved by name.
+    Stage is completed when all its artifacts are saved. When a stage is saved again, the stages that depend on it
+    are not completed anymore, because their inputs have changed.
+    """
+
+    def __init__(self, directory: str, dependencies: dict):
+        self.directory = directory
+        # Mapping from stage to stages which artifacts it uses
+        self.dependencies = dependencies
+        os.makedirs(directory, exist_ok=True)
+        manifest_path = os.path.join(directory, MANIFEST)
+        if os.path.exists(manifest_path):
+            with open(manifest_path) as manifest:
+                self.manifest = json.load(manifest)
+        else:
+            self.manifest = {'stages': {}}
+
+    def write_manifest(self) -> None:
+        """Writes manifest to the directory"""
+        write_json(self.manifest, os.path.join(self.directory, MANIFEST))
+
+    def reset(self) -> None:
+        """Forgets all completed stages. Files are overwritten when stages are saved again"""
+        self.manifest = {'stages': {}}
+        self.write_manifest()
+
+    def is_completed(self, stage: str) -> bool:
+        """Checks if all the artifacts of the stage are saved"""
+        return stage in self.manifest['stages']
+
+    def get_path(self, stage: str, name: str) -> str:
+        """Gets path of the artifact"""
+        return os.path.join(self.directory, f'{stage}.{name}.parquet')
+
+    def invalidate(self, stage: str) -> None:
+        """Marks the stage and all the stages that depend on it not completed"""
+        self.manifest['stages'].pop(stage, None)
+        for dependent, dependencies in self.dependencies.items():
+            if stage in dependencies:
+                self.invalidate(dependent)
+
+    def start(self, stage: str) -> None:
+        """
+        Marks the stage and the stages that depend on it not completed before the stage is run, so they are not
+        skipped on resume if the stage fails half way
+        """
+        self.invalidate(stage)
+        self.write_manifest()
+
+    def save(self, stage: str, frames: dict, duration: Optional[float] = None) -> None:
+        """Saves artifacts of the stage and marks it completed. Memory taken by every frame is noted too"""
+        sizes = {name: write_frame(df, self.get_path(stage, name)) for name, df in frames.items()}
+        self.manifest['stages'][stage] = {
+            'completed_at': datetime.datetime.now().isoformat(timespec='seconds'),
+            'duration_seconds': duration,
+            'artifacts': {name: {'rows': int(df.shape[0]), 'bytes': sizes[name],
+                                 'memory_bytes': get_memory_usage({name: df})} for name, df in frames.items()}}
+        self.write_manifest()
+
+    def get_rows(self, stage: str) -> int:
+        """Gets number of rows in all the artifacts of completed stage"""
+        return sum(artifact['rows'] for artifact in self.manifest['stages'][stage]['artifacts'].values())
+
+    def load(self, stage: str) -> StageArtifacts:
+        """Gives artifacts of completed stage. They are read from disk when they are used"""
+        if not self.is_completed(stage):
+            raise FileNotFoundError(f'Stage {stage} is not completed, its artifacts are missing in '
+                                    f'{self.directory}. Run the stage first')
+        return StageArtifacts(self, stage)
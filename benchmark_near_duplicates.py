@@ -0,0 +1,124 @@
+"""
+Benchmark of near-duplicate detection.
+Synthetic titles are generated with known groups of near-duplicates (words are dropped, added or misspelled).
+Precision and recall of found duplicate pairs and throughput are reported as JSON. On small inputs LSH is compared
+with the brute-force comparison of all pairs.
+"""
+
+from near_duplicates import compute_signatures, find_near_duplicates
+from itertools import combinations
+import argparse
+import random
+import json
+import time
+import numpy as np
+
+SYLLABLES = ['ja', 'zz', 'ni', 'ght', 'fes', 'ti', 'val', 'con', 'cert', 'yo', 'ga', 'ki', 'ds', 'ar', 'sho',
+             'wi', 'ne', 'ta', 'be', 'er', 'mar', 'ket', 'co', 'me', 'dy', 'mu', 'sic', 'da', 'par', 'ty']
+
+
+def generate_words(n_words: int, rng: random.Random) -> list:
+    """Generates vocabulary of pseudo-words"""
+    return list({''.join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 4))) for _ in range(n_words)})
+
+
+def perturb(words: list, vocabulary: list, rng: random.Random) -> list:
+    """Makes a near-duplicate of a title by adding, dropping or misspelling a word"""
+    words = list(words)
+    action = rng.choice(['add', 'drop', 'typo'])
+    if action == 'add':
+        words.insert(rng.randrange(len(words) + 1), rng.choice(vocabulary))
+    elif action == 'drop' and len(words) > 3:
+        words.pop(rng.randrange(len(words)))
+    else:
+        position = rng.randrange(len(words))
+        word = words[position]
+        cut = rng.randrange(len(word))
+        words[position] = word[:cut] + word[cut + 1:]
+    return words
+
+
+def generate_titles(n_titles: int, duplicate_rate: float, seed: int = 0) -> tuple:
+    """
+    Generates titles with groups of near-duplicates.
+    Returns:
+        Titles and group id of every title
+    """
+    rng = random.Random(seed)
+    vocabulary = generate_words(5000, rng)
+    titles, groups = [], []
+    group = 0
+    while len(titles) < n_titles:
+        group += 1
+        base = [rng.choice(vocabulary) for _ in range(rng.randint(4, 9))]
+        titles.append(' '.join(sorted(base)))
+        groups.append(group)
+        while rng.random() < duplicate_rate and len(titles) < n_titles:
+            titles.append(' '.join(sorted(perturb(base, vocabulary, rng))))
+            groups.append(group)
+    return titles, np.array(groups)
+
+
+def get_pairs(labels: np.ndarray) -> set:
+    """Gets all pairs of positions that have the same label"""
+    pairs = set()
+    order = np.argsort(labels, kind='stable')
+    sorted_labels = labels[order]
+    starts = np.flatnonzero(np.r_[True, sorted_labels[1:] != sorted_labels[:-1]])
+    for start, end in zip(starts, np.r_[starts[1:], len(order)]):
+        pairs.update(combinations(sorted(order[start:end]), 2))
+    return pairs
+
+
+def brute_force(titles: list, threshold: float, num_perm: int) -> np.ndarray:
+    """Compares signatures of all pairs of titles. Returns representative position of every title"""
+    signatures = compute_signatures(titles, num_perm=num_perm)
+    representatives = np.arange(len(titles))
+    for i in range(len(titles)):
+        similarity = (signatures[i + 1:] == signatures[i]).mean(axis=1)
+        for j in np.flatnonzero(similarity >= threshold) + i + 1:
+            representatives[representatives == representatives[j]] = representatives[i]
+    return representatives
+
+
+def score(found: np.ndarray, groups: np.ndarray) -> dict:
+    """Computes precision and recall of found duplicate pairs"""
+    found_pairs, true_pairs = get_pairs(found), get_pairs(groups)
+    correct = len(found_pairs & true_pairs)
+    return {'found_pairs': len(found_pairs), 'true_pairs': len(true_pairs),
+            'precision': correct / len(found_pairs) if found_pairs else 1.0,
+            'recall': correct / len(true_pairs) if true_pairs else 1.0}
+
+
+def main() -> None:
+    """Runs the benchmark"""
+    parser = argparse.ArgumentParser(description='Benchmark of near-duplicate detection')
+    parser.add_argument('--titles', type=int, default=100000, help='number of titles to generate')
+    parser.add_argument('--duplicate-rate', type=float, default=0.3,
+                        help='probability that a title gets one more near-duplicate')
+    parser.add_argument('--threshold', type=float, default=0.6, help='similarity threshold')
+    parser.add_argument('--num-perm', type=int, default=128, help='number of MinHash permutations')
+    parser.add_argument('--bands', type=int, default=32, help='number of LSH bands')
+    parser.add_argument('--brute-force-limit', type=int, default=5000,
+                        help='maximum number of titles to run brute-force comparison on')
+    args = parser.parse_args()
+
+    titles, groups = generate_titles(args.titles, args.duplicate_rate)
+    start = time.perf_counter()
+    found = find_near_duplicates(titles, threshold=args.threshold, num_perm=args.num_perm, bands=args.bands)
+    seconds = time.perf_counter() - start
+    results = {'method': 'lsh', 'titles': len(titles), 'seconds': round(seconds, 3),
+               'titles_per_second': round(len(titles) / seconds), **score(found, groups)}
+    print(json.dumps(results))
+
+    if len(titles) <= args.brute_force_limit:
+        start = time.perf_counter()
+        found = brute_force(titles, args.threshold, args.num_perm)
+        seconds = time.perf_counter() - start
+        results = {'method': 'brute_force', 'titles': len(titles), 'seconds': round(seconds, 3),
+                   'titles_per_second': round(len(titles) / seconds), **score(found, groups)}
+        print(json.dumps(results))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,142 @@
+"""
+Benchmark of the whole cleaning pipeline on synthetic data.
+Synthetic scraping DB is generated in SQLite file (see synthetic_data), then process_raw_data, push_clean_data and
+process_tags are run against it. Processing DB is SQLite file too, unless SQLAlchemy URL of another DB (e.g. local
+MySQL with processing DB schema) is given. Tags are classified by stub classifier.
+Wall time, rows per second and peak memory of every stage are reported as JSON, together with records of nested
+stages made by instrumentation (per source, per table) and memory taken by cleaned frames. Peak memory is measured
+in the main process only, so memory of worker processes is not included when --workers is above 1.
+"""
+
+from process_raw_data import process_raw_data, CLEANING_VERSION
+from push_clean_data import push_clean_data
+from process_tags import process_tags
+from remove_tables import ALL_TABLES
+from synthetic_data import generate_scraping_db, create_processing_db
+from tag_classification import StubClassifier
+from sqlalchemy import create_engine, text
+from instrumentation import configure_logging, pop_records, stage
+from compact_frames import enable_arrow_strings, get_memory_usage
+from source_cache import SourceCache
+from typing import Callable
+import functools
+import argparse
+import sqlite3
+import json
+import time
+import os
+
+
+def run_stage(name: str, function: Callable, rows: Callable, results: list):
+    """
+    Runs the stage and adds its wall time, rows per second and peak memory to results. The stage is measured as
+    'benchmark' stage of instrumentation, which samples memory.
+    rows is called with the result of the stage and returns number of processed rows.
+    """
+    with stage('benchmark', benchmark_stage=name) as metrics:
+        start = time.perf_counter()
+        output = function()
+        seconds = time.perf_counter() - start
+    n_rows = rows(output)
+    results.append({'stage': name, 'seconds': round(seconds, 3), 'rows': n_rows,
+                    'rows_per_second': round(n_rows / seconds) if seconds else None,
+                    'peak_rss_mb': round(metrics.peak_rss_bytes / 2 ** 20, 1)})
+    print(json.dumps(results[-1]))
+    return output
+
+
+def classify_synthetic_tag(tag: str) -> str:
+    """Gives a deterministic category path to the synthetic tag"""
+    return f'/Category {len(tag) % 7}/Subcategory {sum(map(ord, tag)) % 40}'
+
+
+def main() -> None:
+    """Runs the benchmark"""
+    parser = argparse.ArgumentParser(description='Benchmark of the cleaning pipeline on synthetic data')
+    parser.add_argument('--events', type=int, default=10000, help='number of raw events to generate')
+    parser.add_argument('--sources', type=int, default=50, help='number of scraping sources')
+    parser.add_argument('--affiliate-share', type=float, default=0.2, help='share of affiliate sources')
+    parser.add_argument('--duplicate-rate', type=float, default=0.2, help='share of duplicated raw events')
+    parser.add_argument('--times-per-event', type=float, default=2.0, help='mean number of times of an event')
+    parser.add_argument('--mixed-rate', type=float, default=0.0,
+                        help='share of times of virtual events that have location')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the generator')
+    parser.add_argument('--workers', type=int, default=1, help='number of processes to clean sources in')
+    parser.add_argument('--load-workers', type=int, default=4, help='number of tables pushed at the same time')
+    parser.add_argument('--classify-latency', type=float, default=0.0,
+                        help='seconds every request to stub classifier takes')
+    parser.add_argument('--workdir', default='benchmark_data', help='directory for SQLite files')
+    parser.add_argument('--reuse', action='store_true',
+                        help='reuse synthetic scraping DB generated by previous run with the same parameters')
+    parser.add_argument('--processing-url', default=None,
+                        help='SQLAlchemy URL of processing DB, SQLite file in workdir is used by default')
+    parser.add_argument('--output', default=None, help='file to write JSON results to')
+    parser.add_argument('--arrow-strings', action='store_true', help='keep text columns as Arrow-backed strings')
+    parser.add_argument('--source-cache', default=None, metavar='DIR',
+                        help='cache cleaned sources in the directory, run the benchmark twice to see the effect')
+    args = parser.parse_args()
+    if args.arrow_strings:
+        enable_arrow_strings()
+    configure_logging()
+
+    os.makedirs(args.workdir, exist_ok=True)
+    generator_params = {'n_sources': args.sources, 'affiliate_share': args.affiliate_share,
+                        'duplicate_rate': args.duplicate_rate, 'times_per_event': args.times_per_event,
+                        'mixed_rate': args.mixed_rate, 'seed': args.seed}
+    scraping_path = os.path.join(args.workdir, f'scraping_{args.events}_{args.seed}.sqlite')
+    results = []
+
+    if not (args.reuse and os.path.exists(scraping_path)):
+        run_stage('generate', lambda: generate_scraping_db(scraping_path, args.events, **generator_params),
+                  lambda counts: sum(counts.values()), results)
+
+    if args.processing_url is None:
+        processing_path = os.path.join(args.workdir, 'processing.sqlite')
+        create_processing_db(processing_path)
+        engine = create_engine(f'sqlite:///{processing_path}')
+    else:
+        engine = create_engine(args.processing_url)
+        with engine.begin() as db_connection:
+            for table_name in ALL_TABLES:
+                db_connection.execute(text(f'DELETE FROM {table_name}'))
+
+    with sqlite3.connect(scraping_path) as connection:
+        n_raw_rows = sum(connection.execute(f'SELECT COUNT(*) FROM {table_name}').fetchone()[0]
+                         for table_name in ['raw_event', 'raw_time', 'raw_price'])
+
+    connect = functools.partial(sqlite3.connect, scraping_path)
+    cache = SourceCache(args.source_cache, version=CLEANING_VERSION) if args.source_cache else None
+    event_df, time_df, price_df = run_stage(
+        'process_raw_data', lambda: process_raw_data(workers=args.workers, connect=connect, cache=cache),
+        lambda output: n_raw_rows, results)
+    n_clean_rows = event_df.shape[0] + time_df.shape[0] + price_df.shape[0]
+    frame_memory = {'clean_frames_mb': round(get_memory_usage({'event': event_df, 'time': time_df,
+                                                               'price': price_df}) / 2 ** 20, 1)}
+    # Frames are bound to the call, so they can be released after it
+    event2time = run_stage('push_clean_data', functools.partial(push_clean_data, event_df, time_df, price_df,
+                                                                connection=engine, load_workers=args.load_workers),
+                           lambda output: n_clean_rows, results)
+    # Only ids and tags of events are needed to process tags, descriptions and other text are released
+    event_df = event_df[['id', 'tags']]
+    del time_df, price_df
+
+    tags = event_df['tags'].dropna().str.split(',').explode().str.strip().str.lower().unique()
+    classifier = StubClassifier({tag: classify_synthetic_tag(tag) for tag in tags}, latency=args.classify_latency)
+    run_stage('process_tags', lambda: process_tags(event_df, event2time, classifier=classifier, classify_rate=None,
+                                                   connection=engine, load_workers=args.load_workers),
+              lambda output: event_df.shape[0], results)
+
+    report = {'parameters': {'events': args.events, 'workers': args.workers, 'load_workers': args.load_workers,
+                             'processing_db': engine.dialect.name, **generator_params},
+              'stages': results,
+              'frame_memory': frame_memory,
+              'stage_records': pop_records(),
+              'total_seconds': round(sum(result['seconds'] for result in results), 3)}
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(report, output, indent=2)
+    print(json.dumps(report))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,113 @@
+"""
+Module contains fast ways to push data to processing DB.
+'load_data' streams df as TSV file to LOAD DATA LOCAL INFILE, 'executemany' sends multi-row inserts.
+In both cases unique and foreign key checks, and autocommit are disabled while the table is loaded. Rows are
+committed only if the whole load succeeds.
+"""
+
+from contextlib import contextmanager
+from sqlalchemy import create_engine
+import pandas as pd
+import numpy as np
+import tempfile
+import os
+
+LOADERS = ['to_sql', 'load_data', 'executemany']
+
+
+@contextmanager
+def bulk_load_session(cursor):
+    """
+    Disables checks and autocommit for the time of the load and enables them back after it. Loaded rows are
+    committed if the load succeeds and rolled back otherwise.
+    """
+    cursor.execute('SET autocommit = 0, unique_checks = 0, foreign_key_checks = 0')
+    try:
+        yield
+        cursor.execute('COMMIT')
+    except BaseException:
+        cursor.execute('ROLLBACK')
+        raise
+    finally:
+        cursor.execute('SET autocommit = 1, unique_checks = 1, foreign_key_checks = 1')
+
+
+def to_db_rows(df: pd.DataFrame) -> list:
+    """Converts df to list of tuples with python types (missing values are converted to None)"""
+    df = df.astype(object)
+    return list(df.where(df.notna(), None).itertuples(index=False, name=None))
+
+
+def to_tsv_value(value) -> str:
+    """
+    Converts value to its text in LOAD DATA. Booleans are written as 0 and 1, and whole floats as ints, because
+    integer columns with missing values are floats in pandas.
+    """
+    if isinstance(value, (bool, np.bool_)):
+        return str(int(value))
+    if isinstance(value, (float, np.floating)) and float(value).is_integer():
+        return str(int(value))
+    return str(value)
+
+
+def escape_tsv_column(column: pd.Series) -> pd.Series:
+    """Converts column to strings in the format of LOAD DATA (special symbols are escaped, NULL is \\N)"""
+    notna = column.notna()
+    if pd.api.types.is_integer_dtype(column.dtype) and notna.all():
+        strings = column.astype(str)
+    else:
+        strings = column.astype(object).where(notna, None).map(to_tsv_value)
+    escaped = strings \
+        .str.replace('\\', '\\\\', regex=False) \
+        .str.replace('\t', '\\t', regex=False) \
+        .str.replace('\n', '\\n', regex=False) \
+        .str.replace('\r', '\\r', regex=False)
+    return escaped.where(notna, '\\N')
+
+
+def write_tsv(df: pd.DataFrame, file) -> None:
+    """Writes df to file in the format of LOAD DATA"""
+    if df.shape[0] == 0:
+        return
+    columns = [escape_tsv_column(df[col]) for col in df.columns]
+    lines = columns[0].str.cat(columns[1:], sep='\t') if len(columns) > 1 else columns[0]
+    file.write('\n'.join(lines.tolist()))
+    file.write('\n')
+
+
+def load_data_infile(df: pd.DataFrame, sql_table_name: str, connection: create_engine) -> None:
+    """
+    Pushes df to DB with LOAD DATA LOCAL INFILE. Engine has to be created with local_infile enabled,
+    and local_infile has to be enabled on the server.
+    """
+    with tempfile.NamedTemporaryFile('w', suffix='.tsv', encoding='utf-8', delete=False) as file:
+        write_tsv(df, file)
+    raw_connection = connection.raw_connection()
+    try:
+        cursor = raw_connection.cursor()
+        columns = ', '.join(df.columns)
+        with bulk_load_session(cursor):
+            cursor.execute(f"LOAD DATA LOCAL INFILE %s INTO TABLE {sql_table_name} CHARACTER SET utf8mb4 "
+                           f"FIELDS TERMINATED BY '\\t' ESCAPED BY '\\\\' LINES TERMINATED BY '\\n' ({columns})",
+                           (file.name,))
+        cursor.close()
+    finally:
+        raw_connection.close()
+        os.remove(file.name)
+
+
+def insert_many(df: pd.DataFrame, sql_table_name: str, connection: create_engine, batch_size: int = 5000) -> None:
+    """Pushes df to DB with multi-row inserts. Every batch is sent as one INSERT statement."""
+    raw_connection = connection.raw_connection()
+    try:
+        cursor = raw_connection.cursor()
+        columns = ', '.join(df.columns)
+        placeholders = ', '.join('%s' for _ in df.columns)
+        rows = to_db_rows(df)
+        with bulk_load_session(cursor):
+            for start in range(0, len(rows), batch_size):
+                cursor.executemany(f'INSERT INTO {sql_table_name} ({columns}) VALUES ({placeholders})',
+                                   rows[start:start + batch_size])
+        cursor.close()
+    finally:
+        raw_connection.close()
@@ -0,0 +1,92 @@
+"""
+Module is used to keep cleaned frames compact in memory.
+Columns with few distinct values (source, state, location, ...) are kept as category dtype, ids are downcast to
+32-bit integers when they fit, and text columns can be kept as Arrow-backed strings (pandas 1.3+ with pyarrow),
+which take much less memory than Python string objects.
+"""
+
+from pandas.api.types import union_categoricals
+import numpy as np
+import pandas as pd
+
+EVENT_CATEGORIES = ['source', 'is_affiliate']
+TIME_CATEGORIES = ['location', 'processed_street_address', 'postal_code', 'state']
+PRICE_CATEGORIES = ['currency']
+EVENT_STRINGS = ['url', 'title', 'image_url', 'description', 'tags', 'title_modified']
+ID_COLUMNS = ['id', 'raw_event_id', 'raw_time_id']
+
+# Arrow strings are disabled by default, because they need newer pandas than the one used in production
+string_settings = {'dtype': None}
+
+
+def enable_arrow_strings() -> None:
+    """Makes compact_frame convert text columns to Arrow-backed strings. Raises ValueError if it is not supported"""
+    try:
+        string_settings['dtype'] = pd.StringDtype('pyarrow')
+    except (AttributeError, TypeError, ImportError) as error:
+        raise ValueError('Arrow strings need pandas 1.3 or newer and pyarrow installed') from error
+
+
+def downcast_ids(values: pd.Series) -> pd.Series:
+    """Converts integer ids to int32 if all of them fit into it"""
+    if values.dtype.kind != 'i' or values.dtype.itemsize <= 4 or values.shape[0] == 0:
+        return values
+    info = np.iinfo(np.int32)
+    if info.min <= values.min() and values.max() <= info.max:
+        return values.astype(np.int32)
+    return values
+
+
+def compact_frame(df: pd.DataFrame, categories: list, strings: list = ()) -> pd.DataFrame:
+    """
+    Converts given columns of df to category dtype, ids to int32 and, if Arrow strings are enabled, given text
+    columns to Arrow-backed strings. Missing columns are skipped.
+    """
+    conversions = {col: downcast_ids(df[col]) for col in ID_COLUMNS if col in df.columns}
+    conversions.update({col: df[col].astype('category') for col in categories
+                        if col in df.columns and not isinstance(df[col].dtype, pd.CategoricalDtype)})
+    if string_settings['dtype'] is not None:
+        conversions.update({col: df[col].astype(string_settings['dtype']) for col in strings if col in df.columns})
+    return df.assign(**conversions) if conversions else df
+
+
+def compact_events(event_df: pd.DataFrame) -> pd.DataFrame:
+    """Compacts cleaned events"""
+    return compact_frame(event_df, EVENT_CATEGORIES, EVENT_STRINGS)
+
+
+def compact_times(time_df: pd.DataFrame) -> pd.DataFrame:
+    """Compacts cleaned times"""
+    return compact_frame(time_df, TIME_CATEGORIES)
+
+
+def compact_prices(price_df: pd.DataFrame) -> pd.DataFrame:
+    """Compacts cleaned prices"""
+    return compact_frame(price_df, PRICE_CATEGORIES)
+
+
+def restore_compact(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Compacts frame read from Parquet again. Parquet keeps only string categories, and Arrow strings are read as
+    objects by older pandas.
+    """
+    return compact_frame(df, EVENT_CATEGORIES + TIME_CATEGORIES + PRICE_CATEGORIES, EVENT_STRINGS)
+
+
+def concat_frames(frames: list) -> pd.DataFrame:
+    """
+    Concatenates frames keeping category columns. pandas turns categories into objects when they differ between
+    frames, so categories of every column are united first.
+    """
+    categorical = [col for col in frames[0].columns if isinstance(frames[0][col].dtype, pd.CategoricalDtype)]
+    if len(frames) > 1 and categorical:
+        dtypes = {col: pd.CategoricalDtype(union_categoricals([frame[col].values for frame in frames],
+                                                              ignore_order=True).categories)
+                  for col in categorical}
+        frames = [frame.astype(dtypes) for frame in frames]
+    return pd.concat(frames)
+
+
+def get_memory_usage(frames: dict) -> int:
+    """Gets memory taken by frames in bytes, including Python objects they keep"""
+    return int(sum(df.memory_usage(deep=True).sum() for df in frames.values()))
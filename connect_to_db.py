@@ -35,9 +35,11 @@ def connect_to_mpdprocessing_new() -> mysql.connector.connect:
 def connect_to_mpdprocessing_new_engine() -> create_engine:
     """
     Get connection to processing DB using SQLAlchemy.
+    LOAD DATA LOCAL INFILE is allowed to use it for bulk loads.
     """
     return create_engine("mysql+pymysql://{user}:{pw}@{host}/{db}"
                          .format(host="",
                                  user="",
                                  pw="",
-                                 db=""))
+                                 db=""),
+                         connect_args={'local_infile': True})
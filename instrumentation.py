@@ -0,0 +1,287 @@
+"""
+Module is used to measure stages of the pipeline.
+Every stage records its duration, rows in and out, bytes read, number of DB round trips and memory high-water
+mark. Finished stages are logged (as JSON if configured) and kept to be exported to Prometheus textfile.
+Stages can be profiled with cProfile or pyinstrument.
+"""
+
+from prometheus_client import CollectorRegistry, Gauge, write_to_textfile
+from contextlib import contextmanager
+from typing import Iterator
+import threading
+import resource
+import logging
+import json
+import re
+import time
+import os
+
+logger = logging.getLogger(__name__)
+
+PAGE_BYTES = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+METRICS = ['duration_seconds', 'rows_in', 'rows_out', 'bytes_read', 'db_round_trips', 'peak_rss_bytes']
+PROFILERS = ['cprofile', 'pyinstrument']
+
+# Records of finished stages
+stage_records = []
+# Stages that are running now, their memory is sampled
+active_stages = []
+counters_lock = threading.Lock()
+# Stages counters of the current thread are added to: the ones started in the thread and the ones of the thread
+# that started it (see inherit_stages), so a stage includes its nested stages. Helper threads that have no
+# stages of their own (e.g. concurrent API requests) add counters to all running stages.
+thread_stages = threading.local()
+# One thread samples memory for all running stages, it is started with the first stage
+sampler_thread = None
+SAMPLE_INTERVAL = 0.05
+profile_settings = {'stages': set(), 'directory': None, 'profiler': 'cprofile'}
+
+
+def get_rss() -> int:
+    """Gets resident memory of the process in bytes. Peak memory of the process is used if /proc is missing"""
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * PAGE_BYTES
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class StageMetrics:
+    """Metrics of one run of a stage. Labels tell runs of the same stage apart (e.g. source or table name)"""
+
+    def __init__(self, name: str, labels: dict):
+        self.name = name
+        self.labels = labels
+        self.duration_seconds = 0.0
+        self.rows_in = 0
+        self.rows_out = 0
+        self.bytes_read = 0
+        self.db_round_trips = 0
+        self.peak_rss_bytes = 0
+        self.extra = {}
+
+    def to_dict(self) -> dict:
+        """Converts metrics to the record of the stage"""
+        return {'stage': self.name, **self.labels, **{metric: getattr(self, metric) for metric in METRICS},
+                **self.extra}
+
+
+class JsonFormatter(logging.Formatter):
+    """Formats log record as one JSON line. Stage metrics are added as fields"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        """Formats the record as JSON object"""
+        entry = {'time': self.formatTime(record), 'level': record.levelname, 'logger': record.name,
+                 'message': record.getMessage()}
+        entry.update(getattr(record, 'metrics', {}))
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+def configure_logging(json_logs: bool = False, level: int = logging.INFO) -> None:
+    """Configures logging of the pipeline to stderr, as plain text or as JSON lines"""
+    handler = logging.StreamHandler()
+    handler.setFormatter(JsonFormatter() if json_logs else
+                         logging.Formatter('%(asctime)s %(levelname)s %(name)s: %(message)s'))
+    root = logging.getLogger()
+    for old_handler in list(root.handlers):
+        root.removeHandler(old_handler)
+    root.addHandler(handler)
+    root.setLevel(level)
+
+
+def configure_profiling(stages: list, directory: str, profiler: str = 'cprofile') -> None:
+    """Enables profiling of given stages. Profile of every run is written to the directory"""
+    if profiler not in PROFILERS:
+        raise ValueError(f'Unknown profiler {profiler!r}, expected one of {PROFILERS}')
+    os.makedirs(directory, exist_ok=True)
+    profile_settings.update(stages=set(stages), directory=directory, profiler=profiler)
+
+
+def update_peak_memory() -> None:
+    """Updates memory high-water mark of running stages"""
+    rss = get_rss()
+    with counters_lock:
+        for metrics in active_stages:
+            metrics.peak_rss_bytes = max(metrics.peak_rss_bytes, rss)
+
+
+def sample_memory() -> None:
+    """Updates memory high-water mark of running stages every SAMPLE_INTERVAL seconds, runs in sampler thread"""
+    while True:
+        update_peak_memory()
+        time.sleep(SAMPLE_INTERVAL)
+
+
+def start_sampler() -> None:
+    """Starts memory sampling thread if it is not running in this process"""
+    global sampler_thread
+    if sampler_thread is None or not sampler_thread.is_alive():
+        sampler_thread = threading.Thread(target=sample_memory, daemon=True)
+        sampler_thread.start()
+
+
+def get_counted_stages() -> list:
+    """Gets stages counters of the current thread are added to. Has to be called with counters_lock"""
+    stages = getattr(thread_stages, 'stages', None)
+    return list(active_stages if stages is None else stages)
+
+
+def current_stages() -> list:
+    """Gets stages counted in the current thread, to pass them to a thread it starts"""
+    with counters_lock:
+        return get_counted_stages()
+
+
+@contextmanager
+def inherit_stages(stages: list) -> Iterator[None]:
+    """Makes the current thread count to given stages (see current_stages) and the stages started in it"""
+    previous = getattr(thread_stages, 'stages', None)
+    thread_stages.stages = list(stages)
+    try:
+        yield
+    finally:
+        thread_stages.stages = previous
+
+
+def add_round_trips(n: int = 1) -> None:
+    """Adds DB (or API) round trips to running stages"""
+    with counters_lock:
+        for metrics in get_counted_stages():
+            metrics.db_round_trips += n
+
+
+def add_read(rows: int, n_bytes: int) -> None:
+    """Adds result of one query (its rows and size in bytes) to running stages"""
+    with counters_lock:
+        for metrics in get_counted_stages():
+            metrics.rows_in += rows
+            metrics.bytes_read += n_bytes
+            metrics.db_round_trips += 1
+
+
+@contextmanager
+def profile(metrics: StageMetrics) -> Iterator[None]:
+    """Profiles the stage if profiling of it is enabled"""
+    if metrics.name not in profile_settings['stages']:
+        yield
+        return
+    labels = ''.join('_' + re.sub(r'\W', '_', str(value)) for value in metrics.labels.values())
+    path = os.path.join(profile_settings['directory'], f'{metrics.name}{labels}_{int(time.time())}')
+    if profile_settings['profiler'] == 'pyinstrument':
+        # Imported here, because pyinstrument is needed only to profile with it
+        from pyinstrument import Profiler
+        profiler = Profiler()
+        profiler.start()
+        try:
+            yield
+        finally:
+            profiler.stop()
+            with open(path + '.html', 'w') as output:
+                output.write(profiler.output_html())
+    else:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            profiler.dump_stats(path + '.prof')
+    logger.info(f'Profile of stage {metrics.name} is written to {path}')
+
+
+@contextmanager
+def stage(name: str, **labels) -> Iterator[StageMetrics]:
+    """
+    Measures the stage. Rows read from DB, bytes read and round trips are added with add_read and add_round_trips,
+    other rows in and rows out are set by the caller on the yielded metrics. The record is logged and kept when
+    the stage finishes.
+    """
+    metrics = StageMetrics(name, labels)
+    metrics.peak_rss_bytes = get_rss()
+    start_sampler()
+    if getattr(thread_stages, 'stages', None) is None:
+        thread_stages.stages = []
+    with counters_lock:
+        active_stages.append(metrics)
+        thread_stages.stages.append(metrics)
+    start = time.perf_counter()
+    try:
+        with profile(metrics):
+            yield metrics
+    except Exception as error:
+        metrics.extra['error'] = repr(error)
+        raise
+    finally:
+        metrics.duration_seconds = round(time.perf_counter() - start, 3)
+        update_peak_memory()
+        with counters_lock:
+            active_stages.remove(metrics)
+            thread_stages.stages.remove(metrics)
+        record(metrics.to_dict())
+
+
+def record(entry: dict) -> None:
+    """Keeps and logs the record of finished stage (also used for records made in worker processes)"""
+    stage_records.append(entry)
+    labels = ''.join(f' {key}={entry[key]}' for key in entry if key not in METRICS and key != 'stage')
+    logger.info(f"Stage {entry['stage']}{labels} finished in {entry['duration_seconds']}s, "
+                f"rows in/out: {entry['rows_in']}/{entry['rows_out']}", extra={'metrics': entry})
+
+
+def add_worker_records(records: list) -> None:
+    """
+    Keeps records of outermost stages made in a worker process. Their rows in, bytes read and round trips are
+    added to running stages of this process.
+    """
+    for entry in records:
+        record(entry)
+        with counters_lock:
+            for metrics in get_counted_stages():
+                metrics.rows_in += entry['rows_in']
+                metrics.bytes_read += entry['bytes_read']
+                metrics.db_round_trips += entry['db_round_trips']
+
+
+def reset() -> None:
+    """Forgets kept records and running stages, e.g. the ones inherited by a forked worker process"""
+    with counters_lock:
+        active_stages.clear()
+        thread_stages.stages = []
+    stage_records.clear()
+
+
+def pop_records() -> list:
+    """Returns kept records and forgets them"""
+    records = list(stage_records)
+    stage_records.clear()
+    return records
+
+
+def write_prometheus_textfile(path: str, prefix: str = 'cleaningdb_stage') -> None:
+    """
+    Writes metrics of kept records in Prometheus text format (for node exporter textfile collector).
+    Runs of a stage with the same labels are summed up, except peak memory, for which maximum is taken.
+    Number of failed runs is written as 'failed' metric. File is replaced atomically by write_to_textfile.
+    """
+    label_names = sorted({key for entry in stage_records for key in entry
+                          if key not in METRICS + ['stage', 'error'] and isinstance(entry[key], str)})
+    series = {}
+    for entry in stage_records:
+        labels = (entry['stage'],) + tuple(str(entry.get(key, '')) for key in label_names)
+        values = series.setdefault(labels, dict.fromkeys(METRICS + ['failed'], 0))
+        for metric in METRICS:
+            if metric == 'peak_rss_bytes':
+                values[metric] = max(values[metric], entry[metric])
+            else:
+                values[metric] += entry[metric]
+        values['failed'] += int('error' in entry)
+
+    registry = CollectorRegistry()
+    for metric in METRICS + ['failed']:
+        gauge = Gauge(f'{prefix}_{metric}', f'{metric} of the stage', ['stage'] + label_names, registry=registry)
+        for labels, values in series.items():
+            gauge.labels(*labels).set(values[metric])
+    write_to_textfile(path, registry)
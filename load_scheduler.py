@@ -0,0 +1,269 @@
+"""
+Module is used to load tables to processing DB concurrently in the order of their foreign keys.
+Every load is a task that starts when the loads it depends on are finished, e.g. time is loaded after event,
+because it needs new ids of events. Independent loads (e.g. tag, subcategory and category) run at the same time
+in a thread pool. Every thread checks out its own connection from the pool of the SQLAlchemy engine.
+A load can stream chunks to a load that depends on it through a bounded queue, so that both of them run at the
+same time, e.g. prices of a time chunk are inserted while the next time chunk is inserted. Memory is bounded by
+the size of the queue.
+Duration of every load and the critical path (the longest chain of dependent loads) are logged. With enough
+workers wall time of all the loads approaches the critical path instead of the sum of all the loads.
+"""
+
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from typing import Callable, Iterator, Optional
+import instrumentation
+import threading
+import logging
+import queue
+import time
+
+logger = logging.getLogger(__name__)
+
+# Put to the queue after the last chunk
+END_OF_CHUNKS = object()
+# How often threads waiting for a queue check if another load has failed, in seconds
+CANCEL_CHECK_INTERVAL = 0.1
+
+
+class LoadCancelled(Exception):
+    """Raised in a load waiting for chunks (or for space in the queue) when another load has failed"""
+
+
+class ChunkChannel:
+    """Queue of chunks from a load to the load streaming from it. max_chunks=0 makes it unbounded"""
+
+    def __init__(self, max_chunks: int, cancelled: threading.Event):
+        self.queue = queue.Queue(maxsize=max_chunks)
+        self.cancelled = cancelled
+
+    def put(self, chunk) -> None:
+        """Puts chunk to the queue, waits while the queue is full"""
+        while True:
+            if self.cancelled.is_set():
+                raise LoadCancelled('Another load failed')
+            try:
+                self.queue.put(chunk, timeout=CANCEL_CHECK_INTERVAL)
+                return
+            except queue.Full:
+                continue
+
+    def close(self) -> None:
+        """Marks that there are no more chunks"""
+        self.put(END_OF_CHUNKS)
+
+    def __iter__(self) -> Iterator:
+        while True:
+            if self.cancelled.is_set():
+                raise LoadCancelled('Another load failed')
+            try:
+                chunk = self.queue.get(timeout=CANCEL_CHECK_INTERVAL)
+            except queue.Empty:
+                continue
+            if chunk is END_OF_CHUNKS:
+                return
+            yield chunk
+
+
+class Load:
+    """
+    Load of the scheduler. function is called with results of the loads it depends on, mapped by their names.
+    If the load streams from another load, chunks of that load are given instead of its result. A load other loads
+    stream from is a generator function: it yields chunks and returns its result.
+    """
+
+    def __init__(self, name: str, function: Callable[[dict], object], dependencies: list,
+                 stream_from: Optional[str]):
+        self.name = name
+        self.function = function
+        self.dependencies = dependencies
+        self.stream_from = stream_from
+        self.streamed_to = None
+        self.started = 0.0
+        self.finished = 0.0
+
+
+class LoadScheduler:
+    """
+    Runs loads in dependency order in max_workers threads. Loads have to be added after the loads they depend on,
+    so dependencies can't have cycles.
+    """
+
+    def __init__(self, name: str, max_workers: int = 4, max_chunks: int = 4):
+        self.name = name
+        self.max_workers = max(1, max_workers)
+        self.max_chunks = max_chunks
+        self.loads = {}
+
+    def add(self, name: str, function: Callable[[dict], object], dependencies: list = (),
+            stream_from: Optional[str] = None) -> None:
+        """
+        Adds the load.
+        Params:
+            function: function that makes the load, see Load
+            dependencies: names of loads which results are needed
+            stream_from: name of the load which chunks are read, the load starts together with it. Only one load can
+                stream from a load.
+        """
+        if name in self.loads:
+            raise ValueError(f'Load {name} is added twice')
+        for dependency in list(dependencies) + ([stream_from] if stream_from else []):
+            if dependency not in self.loads:
+                raise ValueError(f'Load {name} depends on {dependency}, which has to be added before it')
+        if stream_from is not None:
+            if self.loads[stream_from].streamed_to is not None:
+                raise ValueError(f'Load {self.loads[stream_from].streamed_to} already streams from {stream_from}')
+            self.loads[stream_from].streamed_to = name
+        self.loads[name] = Load(name, function, list(dependencies), stream_from)
+
+    def get_group(self, name: str) -> list:
+        """Gets the load and the loads streaming from it (directly or through other loads)"""
+        group = [name]
+        while self.loads[group[-1]].streamed_to is not None:
+            group.append(self.loads[group[-1]].streamed_to)
+        return group
+
+    def is_streamed(self, load: Load) -> bool:
+        """
+        Checks if the load starts together with the load it streams from. Otherwise (there are not enough workers
+        to run the whole chain at once) it starts after that load, and all the chunks are kept in the queue.
+        """
+        if load.stream_from is None:
+            return False
+        root = load.name
+        while self.loads[root].stream_from is not None:
+            root = self.loads[root].stream_from
+        return len(self.get_group(root)) <= self.max_workers
+
+    def get_ready_groups(self, waiting: list, results: dict) -> list:
+        """Gets groups of waiting loads which dependencies are finished"""
+        groups = []
+        for name in waiting:
+            load = self.loads[name]
+            if self.is_streamed(load):
+                # Started by the load it streams from
+                continue
+            group = self.get_group(name) if load.streamed_to is not None else [name]
+            group = [member for member in group if member == name or self.is_streamed(self.loads[member])]
+            dependencies = {dependency for member in group
+                            for dependency in self.loads[member].dependencies + [self.loads[member].stream_from]}
+            if all(dependency in results or dependency in group for dependency in dependencies - {None}):
+                groups.append(group)
+        return groups
+
+    def execute(self, load: Load, inputs: dict, channel: Optional[ChunkChannel], cancelled: threading.Event,
+                stages: list, start: float):
+        """Runs the load in a worker thread. Chunks are put to the channel if another load streams from it"""
+        with instrumentation.inherit_stages(stages):
+            load.started = time.perf_counter() - start
+            try:
+                if channel is None:
+                    return load.function(inputs)
+                chunks = load.function(inputs)
+                while True:
+                    try:
+                        chunk = next(chunks)
+                    except StopIteration as stop:
+                        channel.close()
+                        return stop.value
+                    channel.put(chunk)
+            except BaseException:
+                # Loads waiting for chunks of this load or for space in the queues are stopped
+                cancelled.set()
+                raise
+            finally:
+                load.finished = time.perf_counter() - start
+
+    def run(self) -> dict:
+        """
+        Runs all the loads. If a load fails, no more loads are started, and the error is raised after the running
+        loads are finished.
+        Returns:
+            Results of the loads mapped by their names
+        """
+        with instrumentation.stage('schedule_loads', loads=self.name) as metrics:
+            start = time.perf_counter()
+            cancelled = threading.Event()
+            channels = {name: ChunkChannel(self.max_chunks if self.is_streamed(self.loads[load.streamed_to]) else 0,
+                                           cancelled)
+                        for name, load in self.loads.items() if load.streamed_to is not None}
+            stages = instrumentation.current_stages()
+            waiting = list(self.loads)
+            results = {}
+            running = {}
+            errors = []
+            with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                while waiting or running:
+                    if not errors:
+                        for group in self.get_ready_groups(waiting, results):
+                            if len(group) > self.max_workers - len(running):
+                                continue
+                            for name in group:
+                                load = self.loads[name]
+                                inputs = {dependency: results[dependency] for dependency in load.dependencies}
+                                if load.stream_from is not None:
+                                    inputs[load.stream_from] = channels[load.stream_from]
+                                future = executor.submit(self.execute, load, inputs, channels.get(name), cancelled,
+                                                         stages, start)
+                                running[future] = name
+                                waiting.remove(name)
+                    if not running:
+                        break
+                    finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                    for future in finished:
+                        name = running.pop(future)
+                        try:
+                            results[name] = future.result()
+                        except LoadCancelled:
+                            pass
+                        except Exception as error:
+                            logger.error(f'Load {name} failed: {error!r}')
+                            errors.append(error)
+            if errors:
+                raise errors[0]
+            if waiting:
+                raise RuntimeError(f'Loads {waiting} could not be started')
+
+            metrics.rows_in = len(self.loads)
+            metrics.rows_out = len(results)
+            metrics.extra.update(self.get_report(time.perf_counter() - start))
+            logger.info(f"Loads {self.name} finished in {metrics.extra['wall_seconds']}s, durations of the loads sum "
+                        f"up to {metrics.extra['serial_seconds']}s, critical path {metrics.extra['critical_path']} "
+                        f"takes {metrics.extra['critical_path_seconds']}s")
+        return results
+
+    def get_report(self, wall_seconds: float) -> dict:
+        """
+        Gets durations of the loads and the critical path: the chain of dependent loads that takes the longest.
+        A streamed load overlaps with the load it streams from, so it adds to the path only the time it runs after
+        that load is finished.
+        """
+        # Time from the start to the end of the longest chain ending with the load, and the previous load in it
+        path_end = {}
+        previous = {}
+        for name, load in self.loads.items():
+            duration = load.finished - load.started
+            logger.info(f'Load {name} started at {load.started:.2f}s and took {duration:.2f}s')
+            before = {dependency: path_end[dependency] for dependency in load.dependencies}
+            if self.is_streamed(load):
+                # The load starts together with the load it streams from and can't finish before it
+                producer = self.loads[load.stream_from]
+                producer_start = path_end[load.stream_from] - (producer.finished - producer.started)
+                path_start = max([producer_start] + list(before.values()))
+                path_end[name] = max(path_start + duration, path_end[load.stream_from])
+                if path_end[name] == path_end[load.stream_from] or path_start == producer_start:
+                    before = {load.stream_from: path_end[load.stream_from]}
+            else:
+                if load.stream_from is not None:
+                    before[load.stream_from] = path_end[load.stream_from]
+                path_end[name] = max(before.values(), default=0.0) + duration
+            previous[name] = max(before, key=before.get) if before else None
+
+        last = max(path_end, key=path_end.get)
+        critical_path = [last]
+        while previous[critical_path[-1]] is not None:
+            critical_path.append(previous[critical_path[-1]])
+        return {'wall_seconds': round(wall_seconds, 3),
+                'serial_seconds': round(sum(load.finished - load.started for load in self.loads.values()), 3),
+                'critical_path_seconds': round(path_end[last], 3),
+                'critical_path': ' -> '.join(reversed(critical_path))}
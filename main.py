@@ -4,14 +4,108 @@ Main module to process the raw data.
 2. Deletes the current data in DB.
 3. Fills the new data to DB.
 4. Processes tags and fills it to DB.
+With --incremental flag only tag tables are deleted in step 2, and step 3 inserts, updates and deletes only the
+rows that changed since the previous incremental run.
+Stages are run by pipeline module, which keeps their results on disk, so a failed run can be resumed.
+With --publish flag data is loaded to shadow tables instead of steps 2 and 3, and they replace the live tables
+at once in the end.
 """
 
-from process_raw_data import process_raw_data
-from process_tags import process_tags
-from push_clean_data import push_clean_data
-from remove_tables import delete_data_in_all_tables
+from pipeline import run_pipeline, STAGE_NAMES
+from connect_to_db import connect_to_mpdprocessing_new_engine
+from remove_tables import ALL_TABLES
+from publish import rollback
+from sync_clean_data import clear_ledger
+from compact_frames import enable_arrow_strings
+from bulk_load import LOADERS
+import instrumentation
+import argparse
 
-event_df, time_df, price_df = process_raw_data()
-delete_data_in_all_tables()
-event2time = push_clean_data(event_df, time_df, price_df)
-process_tags(event_df, event2time)
+
+def parse_loader(value: str) -> tuple:
+    """Parses loader option given as TABLE=LOADER"""
+    table_name, _, loader = value.partition('=')
+    if loader not in LOADERS:
+        raise argparse.ArgumentTypeError(f'expected TABLE=LOADER, where LOADER is one of {LOADERS}')
+    return table_name, loader
+
+
+def main() -> None:
+    """Runs the whole pipeline"""
+    parser = argparse.ArgumentParser(description='Cleans scraped data and pushes it to processing DB')
+    parser.add_argument('--incremental', action='store_true',
+                        help='sync only changed rows instead of reloading all the data')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of processes to clean scraping sources in')
+    parser.add_argument('--tag-cache', default='tag_cache.sqlite',
+                        help='path to SQLite cache of tag classification results')
+    parser.add_argument('--tag-cache-ttl', type=float, default=30,
+                        help='number of days after which cached tag classification is refreshed')
+    parser.add_argument('--classify-workers', type=int, default=8,
+                        help='number of concurrent requests to Google language API')
+    parser.add_argument('--classify-rate', type=float, default=10,
+                        help='maximum number of requests to Google language API per second')
+    parser.add_argument('--loader', type=parse_loader, action='append', default=[], metavar='TABLE=LOADER',
+                        help=f'loader used to push the table, one of {LOADERS}. Can be given for several tables')
+    parser.add_argument('--load-workers', type=int, default=4,
+                        help='number of tables pushed to processing DB at the same time, on separate connections')
+    parser.add_argument('--near-duplicate-threshold', type=float, default=None,
+                        help='merge events with title similarity above the threshold (0-1), disabled by default')
+    parser.add_argument('--json-logs', action='store_true', help='write logs and stage metrics as JSON lines')
+    parser.add_argument('--metrics-file', default=None,
+                        help='file to write stage metrics to in Prometheus text format')
+    parser.add_argument('--profile', action='append', default=[], metavar='STAGE',
+                        help='profile the stage (e.g. process_raw_data, clean_source, add_data). Can be given '
+                             'several times')
+    parser.add_argument('--profiler', choices=instrumentation.PROFILERS, default='cprofile',
+                        help='profiler used for --profile')
+    parser.add_argument('--profile-dir', default='profiles', help='directory to write profiles to')
+    parser.add_argument('--artifacts', default='artifacts',
+                        help='directory to keep results of stages in to resume the run from them')
+    parser.add_argument('--resume', action='store_true',
+                        help='skip the stages completed by the previous run and load their results')
+    parser.add_argument('--only', action='append', choices=STAGE_NAMES, default=[], metavar='STAGE',
+                        help=f'run only the stage, one of {STAGE_NAMES}, using saved results of previous stages. '
+                             f'Can be given several times')
+    parser.add_argument('--publish', action='store_true',
+                        help='load data to shadow tables and swap them with live tables at once in the end')
+    parser.add_argument('--keep-generations', type=int, default=2,
+                        help='number of replaced table generations kept for rollback in publish mode')
+    parser.add_argument('--rollback', action='store_true',
+                        help='swap live tables with the latest kept generation and exit')
+    parser.add_argument('--source-cache', default=None, metavar='DIR',
+                        help='directory to cache cleaned sources in, unchanged sources are not cleaned again')
+    parser.add_argument('--source-cache-size', type=float, default=2048, metavar='MB',
+                        help='maximum size of source cache on disk, least recently used sources are evicted')
+    parser.add_argument('--arrow-strings', action='store_true',
+                        help='keep text columns of events as Arrow-backed strings (needs pandas 1.3+)')
+    args = parser.parse_args()
+    if args.publish and args.incremental:
+        parser.error('--publish loads all the data to empty tables, it can not be used with --incremental')
+    args.loaders = dict(args.loader)
+    if args.arrow_strings:
+        try:
+            enable_arrow_strings()
+        except ValueError as error:
+            parser.error(str(error))
+    instrumentation.configure_logging(json_logs=args.json_logs)
+    if args.profile:
+        instrumentation.configure_profiling(args.profile, args.profile_dir, args.profiler)
+
+    if args.rollback:
+        engine = connect_to_mpdprocessing_new_engine()
+        # Ledger of incremental sync points to rows of the replaced tables
+        clear_ledger(engine)
+        rollback(ALL_TABLES, engine)
+        return
+
+    try:
+        run_pipeline(args, directory=args.artifacts, resume=args.resume, only=args.only)
+    finally:
+        # Metrics of failed run are written too, to see which stage failed
+        if args.metrics_file:
+            instrumentation.write_prometheus_textfile(args.metrics_file)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,41 @@
+"""
+One-off migration of processing DB that adds indexed 'raw_id' column to the tables pushed with id mapping.
+The column keeps the id the row had before it was pushed, so new ids can be resolved after the insert
+(see utils.get_id_mapping). Pushes fail with MissingRawIdColumnError until the migration is run:
+    python migrate_raw_id.py
+Tables that already have the column are skipped, so the migration can be run again. Shadow tables of publish are
+created like the live tables and get the column from them.
+"""
+
+from connect_to_db import connect_to_mpdprocessing_new_engine
+from sqlalchemy import create_engine, inspect, text
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Tables pushed with return_mapping=True (see utils.add_data) or synced incrementally
+RAW_ID_TABLES = ['event', 'time', 'price', 'tag', 'subcategory', 'category']
+
+
+def add_raw_id_columns(engine: create_engine, tables: list = RAW_ID_TABLES) -> list:
+    """
+    Adds 'raw_id' column and its index to the tables which don't have it.
+    Returns:
+        Names of the migrated tables
+    """
+    migrated = []
+    for table_name in tables:
+        columns = [column['name'] for column in inspect(engine).get_columns(table_name)]
+        if 'raw_id' in columns:
+            continue
+        with engine.begin() as db_connection:
+            db_connection.execute(text(f'ALTER TABLE {table_name} ADD COLUMN raw_id BIGINT NULL'))
+            db_connection.execute(text(f'CREATE INDEX ix_{table_name}_raw_id ON {table_name} (raw_id)'))
+        migrated.append(table_name)
+        logger.info(f'Added raw_id column to {table_name}')
+    return migrated
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    add_raw_id_columns(connect_to_mpdprocessing_new_engine())
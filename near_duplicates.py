@@ -0,0 +1,181 @@
+"""
+This module is used to find and merge near-duplicate events.
+Titles are split into character shingles and MinHash signature is computed for every title. Signatures are split
+into bands (LSH), and only events that share a band are compared, so not all pairs of events are checked.
+Candidates with estimated similarity above the threshold are merged into the first of them (first source wins).
+Optionally candidates have to share a (start date, location) pair of their times.
+Affiliate events are never merged into other events. Affiliate sources list the same event under different urls,
+and all of them are kept on purpose (see process_raw_data.clean_source_data). Later non-affiliate events are merged
+into an affiliate one, like exact duplicates are. Every event is merged into its earliest near-duplicate rather than
+into a connected group of pairs, so two affiliate events never end up in one group.
+"""
+
+from typing import Optional, Tuple
+import pandas as pd
+import numpy as np
+import logging
+import zlib
+
+logger = logging.getLogger(__name__)
+
+MERSENNE_PRIME = (1 << 31) - 1
+
+
+def get_shingle_hashes(title: str, shingle_size: int = 3) -> np.ndarray:
+    """Hashes all character shingles of the title. Titles shorter than shingle size are hashed as a whole"""
+    shingles = {title[i:i + shingle_size] for i in range(max(1, len(title) - shingle_size + 1))}
+    return np.array([zlib.crc32(shingle.encode('utf-8')) & MERSENNE_PRIME for shingle in shingles], dtype=np.uint64)
+
+
+def compute_signatures(titles: list, num_perm: int = 128, shingle_size: int = 3, seed: int = 1,
+                       block_size: int = 1000) -> np.ndarray:
+    """
+    Computes MinHash signatures of titles.
+    Returns:
+        Array with a row of num_perm hashes for every title
+    """
+    random_state = np.random.RandomState(seed)
+    a = random_state.randint(1, MERSENNE_PRIME, size=num_perm).astype(np.uint64)
+    b = random_state.randint(0, MERSENNE_PRIME, size=num_perm).astype(np.uint64)
+
+    signatures = np.empty((len(titles), num_perm), dtype=np.uint32)
+    for start in range(0, len(titles), block_size):
+        shingle_hashes = [get_shingle_hashes(title, shingle_size) for title in titles[start:start + block_size]]
+        lengths = np.array([len(hashes) for hashes in shingle_hashes])
+        permuted = np.concatenate(shingle_hashes)[:, None] * a + b
+        # (a * x + b) mod prime, computed with shifts, because the prime is Mersenne
+        permuted = (permuted & MERSENNE_PRIME) + (permuted >> 31)
+        permuted = ((permuted & MERSENNE_PRIME) + (permuted >> 31)).astype(np.uint32)
+        # Minimum of every permutation over the shingles of every title
+        signatures[start:start + len(shingle_hashes)] = np.minimum.reduceat(
+            permuted, np.concatenate([[0], np.cumsum(lengths)[:-1]]), axis=0)
+    return signatures
+
+
+def find_candidate_pairs(signatures: np.ndarray, bands: int = 32, max_bucket_size: int = 100) -> np.ndarray:
+    """
+    Finds pairs of titles that have the same hashes in at least one band.
+    Titles of too big buckets are paired only with the first title of the bucket.
+    Returns:
+        Array of unique pairs (i, j), i < j, of title positions
+    """
+    rows = signatures.shape[1] // bands
+    pairs = []
+    for band in range(bands):
+        band_keys = pd.util.hash_pandas_object(
+            pd.DataFrame(signatures[:, band * rows:(band + 1) * rows]), index=False).values
+        order = np.argsort(band_keys, kind='stable')
+        sorted_keys = band_keys[order]
+        bucket_starts = np.flatnonzero(np.r_[True, sorted_keys[1:] != sorted_keys[:-1]])
+        bucket_ends = np.r_[bucket_starts[1:], len(order)]
+        sizes = bucket_ends - bucket_starts
+        # Buckets of the same size are paired at once
+        for size in np.unique(sizes[sizes > 1]):
+            starts = bucket_starts[sizes == size]
+            buckets = np.sort(order[starts[:, None] + np.arange(size)], axis=1)
+            if size > max_bucket_size:
+                i, j = np.zeros(size - 1, dtype=np.int64), np.arange(1, size)
+            else:
+                i, j = np.triu_indices(size, k=1)
+            pairs.append(np.column_stack([buckets[:, i].ravel(), buckets[:, j].ravel()]))
+    if not pairs:
+        return np.empty((0, 2), dtype=np.int64)
+    return np.unique(np.concatenate(pairs), axis=0)
+
+
+def estimate_similarity(signatures: np.ndarray, pairs: np.ndarray, block_size: int = 100000) -> np.ndarray:
+    """Estimates Jaccard similarity of pairs as a share of equal MinHash values"""
+    similarity = np.empty(len(pairs))
+    for start in range(0, len(pairs), block_size):
+        block = pairs[start:start + block_size]
+        similarity[start:start + block_size] = (signatures[block[:, 0]] == signatures[block[:, 1]]).mean(axis=1)
+    return similarity
+
+
+def get_block_keys(time_df: pd.DataFrame) -> pd.DataFrame:
+    """Creates a (start date, location) key for every time. Returns df with columns 'raw_event_id' and 'key'"""
+    location = time_df['location'].astype(object).where(time_df['location'].notna(), 'virtual').astype(str)
+    keys = time_df['start_time'].dt.strftime('%Y-%m-%d') + '|' + location
+    return pd.DataFrame({'raw_event_id': time_df['raw_event_id'].values, 'key': keys.values}).drop_duplicates()
+
+
+def filter_pairs_by_blocks(pairs: np.ndarray, event_ids: np.ndarray, time_df: pd.DataFrame) -> np.ndarray:
+    """Keeps only the pairs of events that have at least one time with the same start date and location"""
+    blocks = get_block_keys(time_df)
+    pairs_df = pd.DataFrame({'left': pairs[:, 0], 'right': pairs[:, 1],
+                             'left_id': event_ids[pairs[:, 0]], 'right_id': event_ids[pairs[:, 1]]})
+    shared = pairs_df \
+        .merge(blocks.rename(columns={'raw_event_id': 'left_id'}), on='left_id') \
+        .merge(blocks.rename(columns={'raw_event_id': 'right_id'}), on=['right_id', 'key']) \
+        .drop_duplicates(['left', 'right'])
+    return shared[['left', 'right']].values
+
+
+def get_representatives(n: int, pairs: np.ndarray) -> np.ndarray:
+    """
+    Returns position of the representative for every position. Pairs are (earlier, later) positions. Every later
+    title is attached to its earliest near-duplicate, and representative is the first title of that chain, so
+    titles are not united through a chain of pairs they are not part of.
+    """
+    parents = np.arange(n)
+    np.minimum.at(parents, pairs[:, 1], pairs[:, 0])
+    while True:
+        representatives = parents[parents]
+        if np.array_equal(representatives, parents):
+            return representatives
+        parents = representatives
+
+
+def find_near_duplicates(titles: list, threshold: float = 0.8, num_perm: int = 128, bands: int = 32,
+                         shingle_size: int = 3, event_ids: Optional[np.ndarray] = None,
+                         time_df: Optional[pd.DataFrame] = None,
+                         protected: Optional[np.ndarray] = None) -> np.ndarray:
+    """
+    Finds near-duplicate titles.
+    Params:
+        titles: titles to check
+        threshold: minimum estimated Jaccard similarity of shingles of near-duplicate titles
+        num_perm: number of MinHash permutations
+        bands: number of LSH bands, num_perm has to be divisible by it
+        shingle_size: number of characters in a shingle
+        event_ids: ids of events of the titles, needed for blocking
+        time_df: times of the events. If given, near-duplicates have to share start date and location
+        protected: mask of titles that are not merged into other titles. Later titles can be merged into them
+    Returns:
+        Position of the representative title for every title
+    """
+    signatures = compute_signatures(titles, num_perm=num_perm, shingle_size=shingle_size)
+    pairs = find_candidate_pairs(signatures, bands=bands)
+    pairs = pairs[estimate_similarity(signatures, pairs) >= threshold]
+    if protected is not None:
+        pairs = pairs[~protected[pairs[:, 1]]]
+    if time_df is not None and len(pairs):
+        pairs = filter_pairs_by_blocks(pairs, event_ids, time_df)
+    return get_representatives(len(titles), pairs)
+
+
+def merge_near_duplicates(event_df: pd.DataFrame, time_df: pd.DataFrame, threshold: float = 0.8,
+                          block_on_time: bool = True, **lsh_params) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """
+    Merges near-duplicate events by title_modified. Only the first event of every group of near-duplicates is kept,
+    times of the others are moved to it. Affiliate events are always kept, later non-affiliate near-duplicates are
+    merged into them. lsh_params are passed to find_near_duplicates.
+    """
+    if event_df.shape[0] == 0:
+        return event_df, time_df
+    event_ids = event_df['id'].values
+    is_affiliate = event_df['is_affiliate'].astype(object).isin([1, '1']).values \
+        if 'is_affiliate' in event_df.columns else None
+    representatives = find_near_duplicates(event_df['title_modified'].tolist(), threshold=threshold,
+                                           event_ids=event_ids, time_df=time_df if block_on_time else None,
+                                           protected=is_affiliate, **lsh_params)
+    is_duplicate = representatives != np.arange(len(representatives))
+    logger.info(f'Near-duplicate events merged: {is_duplicate.sum()}')
+    if not is_duplicate.any():
+        return event_df, time_df
+
+    # Move times of duplicates to the kept events and drop times that became the same
+    new_event_ids = pd.Series(event_ids[representatives], index=event_ids)
+    time_df = time_df.assign(raw_event_id=time_df['raw_event_id'].map(new_event_ids).values)
+    time_df = time_df.drop_duplicates(subset=[col for col in time_df.columns if col not in ['id']])
+    return event_df[~is_duplicate], time_df
@@ -0,0 +1,153 @@
+"""
+Module is used to run the pipeline stage by stage with intermediate results kept on disk.
+1. process_raw_data - cleaned event, time and price frames, and tags of events separately, so the stages that
+   need only tags do not read descriptions and other text of events.
+2. push_clean_data - clears (or syncs) processing DB and pushes cleaned data. Mapping of event ids is saved.
+3. classify_tags - classified tags.
+4. push_tags - tag tables are cleared and pushed again.
+5. publish - in publish mode data is pushed to shadow tables in stages 2 and 4, and they are swapped with live
+   tables here (see publish module). Otherwise nothing is done.
+Every stage reads its inputs from artifacts of previous stages, so after a failure the run can be resumed from
+the failed stage, and any stage can be run again alone for debugging. Stages that write to DB clear what they
+write first, so they can be rerun. Frames are released after every stage, and memory report of the stages is
+logged in the end.
+"""
+
+from process_raw_data import process_raw_data, CLEANING_VERSION
+from source_cache import SourceCache
+from process_tags import classify_tags, get_tags_to_check, push_tags
+from push_clean_data import push_clean_data
+from remove_tables import delete_data_in_all_tables, delete_data_in_tables, ALL_TABLES, TAG_TABLES
+from connect_to_db import connect_to_mpdprocessing_new_engine
+from publish import prepare_shadow_tables, publish, SHADOW_SUFFIX
+from sync_clean_data import clear_ledger, sync_clean_data
+from tag_classification import GoogleLanguageClassifier
+from artifacts import ArtifactStore
+from compact_frames import get_memory_usage
+from tag_cache import TagCache
+from typing import Optional
+import instrumentation
+import argparse
+import logging
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+
+def run_process_raw_data(inputs: dict, options: argparse.Namespace) -> dict:
+    """Extracts and cleans raw data"""
+    cache = None
+    if options.source_cache:
+        cache = SourceCache(options.source_cache, version=CLEANING_VERSION,
+                            max_bytes=int(options.source_cache_size * 2 ** 20))
+    event_df, time_df, price_df = process_raw_data(workers=options.workers,
+                                                   near_duplicate_threshold=options.near_duplicate_threshold,
+                                                   cache=cache)
+    return {'event': event_df, 'event_tags': event_df[['id', 'tags']], 'time': time_df, 'price': price_df}
+
+
+def run_push_clean_data(inputs: dict, options: argparse.Namespace) -> dict:
+    """Pushes (or syncs) cleaned data to processing DB. Returns mapping of event ids"""
+    # Frames are read from artifacts for this stage only, so they can be changed in place while pushed
+    event_df, time_df, price_df = [inputs['process_raw_data'][name] for name in ['event', 'time', 'price']]
+    if options.publish:
+        # Live tables are not touched, all the tables are loaded to empty shadow tables. Ledger of incremental
+        # sync is cleared before, because live tables are replaced
+        engine = connect_to_mpdprocessing_new_engine()
+        clear_ledger(engine)
+        prepare_shadow_tables(ALL_TABLES, engine)
+        event2time = push_clean_data(event_df, time_df, price_df, loaders=options.loaders,
+                                     table_suffix=SHADOW_SUFFIX, load_workers=options.load_workers)
+    elif options.incremental:
+        delete_data_in_tables(TAG_TABLES)
+        event2time = sync_clean_data(event_df, time_df, price_df, loaders=options.loaders)
+    else:
+        clear_ledger(connect_to_mpdprocessing_new_engine())
+        delete_data_in_all_tables()
+        event2time = push_clean_data(event_df, time_df, price_df, loaders=options.loaders,
+                                     load_workers=options.load_workers)
+    return {'event2time': event2time.to_frame()}
+
+
+def run_classify_tags(inputs: dict, options: argparse.Namespace) -> dict:
+    """Classifies frequent tags of cleaned events. Returns category path of every classified tag"""
+    tags_to_check = get_tags_to_check(inputs['process_raw_data']['event_tags'])
+    # Classifier is created by classify_tags only if some tags are missing in the cache
+    cache = TagCache(options.tag_cache, version=GoogleLanguageClassifier.version, ttl_days=options.tag_cache_ttl)
+    try:
+        subcat2tag = classify_tags(tags_to_check, classifier=None, cache=cache,
+                                   max_workers=options.classify_workers, requests_per_second=options.classify_rate)
+    finally:
+        cache.close()
+    return {'subcat2tag': pd.DataFrame({'tag': list(subcat2tag.keys()), 'path': list(subcat2tag.values())})}
+
+
+def run_push_tags(inputs: dict, options: argparse.Namespace) -> dict:
+    """Clears tag tables and pushes classified tags to them"""
+    subcat2tag = inputs['classify_tags']['subcat2tag']
+    table_suffix = SHADOW_SUFFIX if options.publish else ''
+    delete_data_in_tables([table_name + table_suffix for table_name in TAG_TABLES])
+    push_tags(inputs['process_raw_data']['event_tags'], inputs['push_clean_data']['event2time']['id_db'],
+              dict(zip(subcat2tag['tag'], subcat2tag['path'].map(list))), loaders=options.loaders,
+              table_suffix=table_suffix, load_workers=options.load_workers)
+    return {}
+
+
+def run_publish(inputs: dict, options: argparse.Namespace) -> dict:
+    """Swaps loaded shadow tables with live tables in publish mode"""
+    if options.publish:
+        publish(ALL_TABLES, connect_to_mpdprocessing_new_engine(), keep=options.keep_generations)
+    return {}
+
+
+# Stage name, function and stages which artifacts are its inputs
+STAGES = [
+    ('process_raw_data', run_process_raw_data, []),
+    ('push_clean_data', run_push_clean_data, ['process_raw_data']),
+    ('classify_tags', run_classify_tags, ['process_raw_data']),
+    ('push_tags', run_push_tags, ['process_raw_data', 'push_clean_data', 'classify_tags']),
+    ('publish', run_publish, ['push_clean_data', 'push_tags']),
+]
+STAGE_NAMES = [name for name, _, _ in STAGES]
+STAGE_DEPENDENCIES = {name: dependencies for name, _, dependencies in STAGES}
+
+
+def run_pipeline(options: argparse.Namespace, directory: str = 'artifacts', resume: bool = False,
+                 only: Optional[list] = None) -> None:
+    """
+    Runs stages of the pipeline and saves their artifacts to the directory.
+    Params:
+        options: parsed options of main.py
+        directory: directory to keep artifacts in
+        resume: skip the stages completed by previous run
+        only: names of stages to run, inputs are loaded from artifacts of previous runs. Stages that depend on them
+            have to be run again, because their inputs change.
+    """
+    store = ArtifactStore(directory, STAGE_DEPENDENCIES)
+    if not resume and not only:
+        store.reset()
+
+    # Metrics of the stages run, to log memory report in the end, also when a stage fails
+    stage_metrics = []
+    try:
+        for name, function, dependencies in STAGES:
+            if only and name not in only:
+                continue
+            if resume and not only and store.is_completed(name):
+                logger.info(f'Stage {name} is completed, its artifacts are loaded from {directory}')
+                continue
+            inputs = {dependency: store.load(dependency) for dependency in dependencies}
+            store.start(name)
+            with instrumentation.stage('pipeline', step=name) as metrics:
+                stage_metrics.append(metrics)
+                metrics.rows_in = sum(store.get_rows(dependency) for dependency in dependencies)
+                outputs = function(inputs, options)
+                metrics.rows_out = sum(df.shape[0] for df in outputs.values())
+                metrics.extra['memory_bytes'] = get_memory_usage(outputs)
+            store.save(name, outputs, duration=metrics.duration_seconds)
+            # Frames of the stage are on disk now, the next stages read only what they use
+            del inputs, outputs
+    finally:
+        for metrics in stage_metrics:
+            logger.info(f"Memory of stage {metrics.labels['step']}: peak RSS {metrics.peak_rss_bytes / 2 ** 20:.1f} "
+                        f"MB, results {metrics.extra.get('memory_bytes', 0) / 2 ** 20:.1f} MB")
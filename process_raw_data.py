@@ -2,72 +2,189 @@
 This module is used to process raw data.
 """
 
-from utils import remove_punctuations, remove_stopwords, imply_stemming, str2datetime, datetime2date, remove_html_tag
+from utils import map_unique, normalize_titles, parse_datetimes, remove_html_tag
+from stream_raw_data import read_table_in_pages, read_rows_by_ids, read_source_fingerprint
+from source_cache import SourceCache
+from near_duplicates import merge_near_duplicates
+from compact_frames import compact_events, compact_prices, compact_times, concat_frames, get_memory_usage
+import compact_frames
 from connect_to_db import connect_to_mpdscraping
-from typing import Tuple
+from concurrent.futures import ProcessPoolExecutor
+from typing import Callable, Iterator, Optional, Tuple
+import instrumentation
 import mysql.connector
 import pandas as pd
+import numpy as np
 import datetime
+import logging
 import html
 
+logger = logging.getLogger(__name__)
+
+# Version of cleaning of events and times. It has to be increased when their cleaning changes, so that sources
+# cached by previous version are cleaned again
+CLEANING_VERSION = 1
+
 
 def process_initial_events(event_df: pd.DataFrame) -> pd.DataFrame:
     """Initial processing of event table. All processing steps are written in comments below"""
     # Leave only good events (good event is the one that has both title and url)
     event_df = event_df.dropna(subset=['title', 'url'])
     # Escape html symbols
-    event_df[['title', 'description']] = event_df[['title', 'description']].applymap(
-        lambda x: html.unescape(str(x)) if pd.notna(x) else x)
-    # Remove html anchors from description
-    event_df['description'] = event_df['description'].apply(remove_html_tag)
+    event_df = event_df.assign(title=map_unique(event_df['title'], lambda x: html.unescape(str(x))))
+    event_df = clean_descriptions(event_df)
     # Removing totally similar events
     event_df = event_df.drop_duplicates(
         subset=[col for col in event_df.columns if col not in ['id']])
     # Removing canceled events
     cancel = event_df['title'].apply(lambda x: 'cancel' in x.lower() or 'pospone' in x.lower() if x else False)
     event_df = event_df[~cancel]
-    print('Shape of processing data:', event_df.shape)
+    logger.info(f'Shape of processing data: {event_df.shape}')
     # Process title
-    event_df['title_modified'] = event_df['title'].str.lower() \
-        .apply(remove_punctuations) \
-        .apply(remove_stopwords) \
-        .apply(imply_stemming) \
-        .apply(lambda x: ' '.join(sorted(x.split())))
+    event_df['title_modified'] = normalize_titles(event_df['title'])
     return event_df
 
 
-def process_initial_time(time_df: pd.DataFrame) -> pd.DataFrame:
-    """Initial processing of time table. All processing steps are written in comments below"""
-    current_date = datetime.date.today()
-    year_date = datetime.date.today() + datetime.timedelta(days=365 * 4)
+def clean_descriptions(event_df: pd.DataFrame) -> pd.DataFrame:
+    """Escapes html symbols and removes html anchors from descriptions. Every distinct description is cleaned once"""
+    with instrumentation.stage('clean_descriptions') as metrics:
+        metrics.rows_in = event_df.shape[0]
+        descriptions = map_unique(event_df['description'], lambda x: remove_html_tag(html.unescape(str(x))))
+        metrics.rows_out = descriptions.shape[0]
+        metrics.extra['distinct'] = int(event_df['description'].nunique())
+    return event_df.assign(description=descriptions)
+
 
+def process_initial_time(time_df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Initial processing of time table. All processing steps are written in comments below. Times out of the date
+    window are dropped later by filter_time_window, so that the result does not depend on the date.
+    """
     # Drop duplicated records
     time_df = time_df.drop_duplicates(subset=[col for col in time_df.columns if col not in ['id']])
 
-    time_df['start_time'] = time_df['start_time'].apply(str2datetime)
-    time_df['end_time'] = time_df['end_time'].apply(str2datetime)
+    time_df['start_time'], failed_start = parse_datetimes(time_df['start_time'])
+    time_df['end_time'], failed_end = parse_datetimes(time_df['end_time'])
+    if failed_start or failed_end:
+        logger.warning(f'Failed to parse {failed_start} start times and {failed_end} end times')
     # Drop records that don't have start time
-    time_df = time_df.dropna(subset=['start_time'])
-    # Drop records that are planned to happen more than 4 years from now
-    time_df = time_df[time_df['start_time'].apply(lambda x: current_date <= datetime2date(x) <= year_date)]
-    return time_df
+    return time_df.dropna(subset=['start_time'])
 
 
-def get_filter_query(filter_list_num: int, table_name: str, column_name: str) -> str:
-    """Creates command to use it to query DB and get needed data"""
-    placeholder = '%s'
-    placeholders = ', '.join(placeholder for _ in range(filter_list_num))
-    query_to_filter = f'select * from {table_name} where {column_name} in (%s)' % placeholders
-    return query_to_filter
+def filter_time_window(time_df: pd.DataFrame) -> pd.DataFrame:
+    """Drops times that started before today or are planned to happen more than 4 years from now"""
+    current_date = pd.Timestamp(datetime.date.today())
+    year_date = pd.Timestamp(datetime.date.today() + datetime.timedelta(days=365 * 4))
+    start_date = time_df['start_time'].dt.normalize()
+    time_df = time_df[(current_date <= start_date) & (start_date <= year_date)]
+    return time_df
 
 
-def get_event_time_concated(source: str, is_affiliate: bool, connection: mysql.connector.connect,
-                            main_df_event: pd.DataFrame, main_df_time: pd.DataFrame) -> Tuple[
-                            pd.DataFrame, pd.DataFrame]:
-    """Gets raw event and time tables and processes them"""
-    event_chunk = pd.read_sql_query(f"select * from raw_event where source = '{source}'",
-                                    connection)
-    event_chunk = process_initial_events(event_chunk)
+class SourceAccumulator:
+    """
+    Collects processed events and times of all sources. Chunks are kept in lists and concatenated only once
+    in the end. Set of already added title_modified values is kept to let the first source win when several
+    sources have the same event. Chunks are expected to be compacted (see compact_frames), category columns
+    keep their dtype after concatenation.
+    """
+
+    def __init__(self, event_columns: list, time_columns: list):
+        self.event_columns = event_columns
+        self.time_columns = time_columns
+        self.seen_titles = set()
+        self.event_chunks = []
+        self.time_chunks = []
+        self.n_events = 0
+
+    def is_new_title(self, titles: pd.Series) -> pd.Series:
+        """Checks which titles have not been added yet"""
+        seen_titles = self.seen_titles
+        return pd.Series([title not in seen_titles for title in titles], index=titles.index, dtype=bool)
+
+    def add(self, event_chunk: pd.DataFrame, time_chunk: pd.DataFrame) -> None:
+        """Adds events which title_modified has not been added yet and their times"""
+        event_chunk = event_chunk[self.is_new_title(event_chunk['title_modified'])]
+        time_chunk = time_chunk[time_chunk['raw_event_id'].isin(event_chunk['id'])]
+        self.seen_titles.update(event_chunk['title_modified'])
+        self.event_chunks.append(event_chunk)
+        self.time_chunks.append(time_chunk)
+        self.n_events += event_chunk.shape[0]
+
+    def concat(self) -> Tuple[pd.DataFrame, pd.DataFrame]:
+        """Concatenates all added chunks"""
+        if not self.event_chunks:
+            return pd.DataFrame([], columns=self.event_columns), pd.DataFrame([], columns=self.time_columns)
+        return concat_frames(self.event_chunks), concat_frames(self.time_chunks)
+
+
+def clean_source(source: str, is_affiliate: bool, connection: mysql.connector.connect,
+                 accumulator: Optional[SourceAccumulator] = None, cache: Optional[SourceCache] = None,
+                 key: Optional[list] = None) -> Optional[Tuple[pd.DataFrame, pd.DataFrame]]:
+    """
+    Gets raw event and time tables of the source and processes them.
+    If accumulator is given, events which title_modified has been already added are skipped before querying times.
+    If cache is given, the source is taken from it when its raw data has not changed (key is the fingerprint of
+    raw data, it is read if not given), otherwise the cleaned source is saved to it.
+    Returns:
+        Events that have times and their times (compacted, see compact_frames) or None if there are no such events
+    """
+    with instrumentation.stage('clean_source', source=source) as metrics:
+        if cache is None:
+            cleaned = finish_source_data(*clean_source_data(source, is_affiliate, connection, accumulator))
+        else:
+            name = get_cache_name(source, is_affiliate)
+            key = key or read_source_fingerprint(connection, source)
+            extracted = cache.get(name, key)
+            metrics.extra['cached'] = extracted is not None
+            if extracted is None:
+                # Source is cached before filtering against other sources, so the entry is valid for any run
+                extracted = clean_source_data(source, is_affiliate, connection)
+                cache.put(name, key, *extracted)
+            cleaned = finish_source_data(*extracted)
+        if cleaned is not None:
+            metrics.rows_out = cleaned[0].shape[0] + cleaned[1].shape[0]
+    return cleaned
+
+
+def get_cache_name(source: str, is_affiliate: bool) -> str:
+    """Gets name of the source in source cache. Source is cleaned differently when it is affiliate"""
+    return f"{'affiliate' if is_affiliate else 'other'}:{source}"
+
+
+def finish_source_data(event_chunk: pd.DataFrame, time_df: pd.DataFrame) -> Optional[
+                       Tuple[pd.DataFrame, pd.DataFrame]]:
+    """
+    Drops times out of the date window and events without times. Returns compacted events and times or None if
+    there are no such events
+    """
+    if time_df.shape[0] == 0:
+        return None
+    time_df = filter_time_window(time_df)
+    if time_df.shape[0] == 0:
+        return None
+    # Keep only events that have times
+    event_chunk = event_chunk[event_chunk['id'].isin(time_df['raw_event_id'].unique())]
+    return compact_events(event_chunk), compact_times(time_df)
+
+
+def clean_source_data(source: str, is_affiliate: bool, connection: mysql.connector.connect,
+                      accumulator: Optional[SourceAccumulator] = None) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """
+    Reads and processes events and times of the source (see clean_source). Times are not filtered by the date
+    window yet (see finish_source_data).
+    Returns:
+        Events and their times, empty frames if the source has no events
+    """
+    # Events are read and processed page by page, then duplicates between pages are removed
+    event_pages = [process_initial_events(page)
+                   for page in read_table_in_pages(connection, 'raw_event', 'source', source)]
+    if not event_pages:
+        return pd.DataFrame(), pd.DataFrame()
+    event_chunk = pd.concat(event_pages)
+    # Every page is already without duplicates, so only events of several pages are compared again
+    if len(event_pages) > 1:
+        event_chunk = event_chunk.drop_duplicates(
+            subset=[col for col in event_chunk.columns if col not in ['id', 'title_modified']])
     # If source is affiliate filter events both by url and title_modified, because there are sources that have
     # same event name but different urls to event. It is important to keep affiliates.
     if is_affiliate:
@@ -76,93 +193,195 @@ def get_event_time_concated(source: str, is_affiliate: bool, connection: mysql.c
     else:
         event_chunk = event_chunk.drop_duplicates('title_modified')
     # Check if event title_modified has not been already added previously.
-    event_chunk = event_chunk[~event_chunk['title_modified'].isin(main_df_event['title_modified'])]
+    if accumulator is not None:
+        event_chunk = event_chunk[accumulator.is_new_title(event_chunk['title_modified'])]
 
     # Process time data
+    # All times of one event are in the same chunk, so chunks can be processed separately
     list_event_ids = event_chunk['id'].unique().tolist()
-    query_to_filter = get_filter_query(len(list_event_ids), 'raw_time', 'raw_event_id')
-    time_df = pd.read_sql_query(query_to_filter, connection, params=list_event_ids)
-
-    time_df = process_initial_time(time_df)
+    time_chunks = [process_initial_time(chunk)
+                   for chunk in read_rows_by_ids(connection, 'raw_time', 'raw_event_id', list_event_ids)]
+    return event_chunk, pd.concat(time_chunks) if time_chunks else pd.DataFrame()
 
-    if time_df.shape[0] == 0:
-        return main_df_event, main_df_time
-
-    event_chunk = event_chunk[event_chunk['id'].isin(time_df['raw_event_id'].unique())]
 
-    # Add new event and drop not needed ones
-    main_df_event = pd.concat([main_df_event, event_chunk])
-
-    main_df_time = pd.concat([main_df_time, time_df])
-    main_df_time = main_df_time[main_df_time['raw_event_id'].isin(main_df_event['id'].unique())]
-
-    return main_df_event, main_df_time
-
-
-def process_raw_data() -> Tuple[pd.DataFrame, pd.DataFrame, pd.DataFrame]:
-    """Main function to process raw data"""
-    mpdscraping_connection_event = connect_to_mpdscraping()
-
-    event_new_df = pd.DataFrame([], columns=['id', 'url', 'title', 'image_url', 'description',
-                                             'source', 'is_affiliate', 'title_modified'])
-
-    time_new_df = pd.DataFrame([], columns=['id', 'raw_event_id', 'start_time', 'end_time', 'location',
-                                            'processed_street_address', 'postal_code', 'longitude', 'latitude',
-                                            'state'])
-
-    affiliate_sources = \
-        pd.read_sql("SELECT DISTINCT source FROM raw_event WHERE is_affiliate = '1';", mpdscraping_connection_event)[
-            'source'].to_list()
-    other_sources = \
-        pd.read_sql("SELECT DISTINCT source FROM raw_event WHERE is_affiliate = '0';", mpdscraping_connection_event)[
-            'source'].to_list()
-
-    for affiliate_source in affiliate_sources:
-        event_new_df, time_new_df = get_event_time_concated(source=affiliate_source, is_affiliate=True,
-                                                            connection=mpdscraping_connection_event,
-                                                            main_df_event=event_new_df, main_df_time=time_new_df)
-
-        print(f"Source '{affiliate_source}' processed. Shape of main event data: {event_new_df.shape}")
-
-    for other_source in other_sources:
-        event_new_df, time_new_df = get_event_time_concated(source=other_source, is_affiliate=False,
-                                                            connection=mpdscraping_connection_event,
-                                                            main_df_event=event_new_df, main_df_time=time_new_df)
-
-        print(f"Source '{other_source}' processed. Shape of main event data: {event_new_df.shape}")
-
-    # Add virtual event column
-    time_new_df['is_virtual'] = time_new_df['location'].isna() + 0
-    # Check if event has only one type of events (virtual or not)
-    check_virtual = time_new_df.groupby('raw_event_id')['is_virtual'].nunique()
-    if check_virtual.nunique() != 1:
-        print('Number of events that have both virtual and not virtual locations:', (check_virtual > 1).sum())
+def get_event_time_concated(source: str, is_affiliate: bool, connection: mysql.connector.connect,
+                            accumulator: SourceAccumulator, cache: Optional[SourceCache] = None) -> None:
+    """Gets raw event and time tables, processes them and adds them to accumulator"""
+    cleaned = clean_source(source, is_affiliate, connection, accumulator, cache=cache)
+    if cleaned is not None:
+        accumulator.add(*cleaned)
+
+
+# Connection to scraping DB opened once in every worker process
+worker_connection = None
+
+
+def init_worker(connect: Callable[[], mysql.connector.connect], string_settings: dict) -> None:
+    """Opens connection to scraping DB in worker process and applies settings of compact frames of main process"""
+    global worker_connection
+    instrumentation.reset()
+    compact_frames.string_settings.update(string_settings)
+    worker_connection = connect()
+
+
+def clean_source_in_worker(source_with_flags: Tuple[str, bool, bool]) -> Tuple[
+                           Optional[Tuple[pd.DataFrame, pd.DataFrame]], list]:
+    """
+    Processes the source in worker process. Filtering against other sources is done later in main process.
+    If the source is going to be cached, only clean_source_data is run, the rest is done in main process, which
+    owns the cache.
+    Returns:
+        Result of clean_source (or clean_source_data) and stage records made in the worker
+    """
+    source, is_affiliate, to_cache = source_with_flags
+    if to_cache:
+        with instrumentation.stage('clean_source', source=source) as metrics:
+            cleaned = clean_source_data(source, is_affiliate, worker_connection)
+            metrics.extra['cached'] = False
+    else:
+        cleaned = clean_source(source, is_affiliate, worker_connection)
+    return cleaned, instrumentation.pop_records()
+
+
+def clean_sources_in_workers(sources: list, workers: int, connect: Callable[[], mysql.connector.connect],
+                             connection: mysql.connector.connect,
+                             cache: Optional[SourceCache] = None) -> Iterator[Optional[Tuple[pd.DataFrame,
+                                                                                             pd.DataFrame]]]:
+    """
+    Cleans sources in worker processes and yields results of clean_source in the order of sources. If cache is
+    given, cached sources are taken from it in this process, and only changed sources are sent to workers.
+    """
+    keys = {}
+    to_clean = sources
+    if cache is not None:
+        keys = {source: read_source_fingerprint(connection, source[0]) for source in sources}
+        to_clean = [source for source in sources if not cache.contains(get_cache_name(*source), keys[source])]
+        cache.misses += len(to_clean)
+    cleaned_in_workers = set(to_clean)
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker,
+                             initargs=(connect, compact_frames.string_settings)) as executor:
+        results = executor.map(clean_source_in_worker,
+                               [(source, is_affiliate, cache is not None) for source, is_affiliate in to_clean])
+        for source, is_affiliate in sources:
+            if (source, is_affiliate) not in cleaned_in_workers:
+                yield clean_source(source, is_affiliate, connection, cache=cache, key=keys[(source, is_affiliate)])
+                continue
+            cleaned, records = next(results)
+            instrumentation.add_worker_records(records)
+            if cache is not None:
+                cache.put(get_cache_name(source, is_affiliate), keys[(source, is_affiliate)], *cleaned)
+                cleaned = finish_source_data(*cleaned)
+            yield cleaned
+
+
+def flag_virtual_events(event_df: pd.DataFrame, time_df: pd.DataFrame) -> Tuple[pd.DataFrame, pd.DataFrame, int]:
+    """
+    Adds is_virtual column to events: 0 for events with location, 1 for virtual events (without location in all
+    times or with 'virtual' in title) and 2 for live streams ('live stream' in title).
+    Events that have times both with and without location are dropped with their times.
+    Returns:
+        events, times and number of dropped mixed events
+    """
+    has_location = time_df['location'].notna().values
+    time_event_ids = time_df['raw_event_id'].values
+    virtual_ids = pd.unique(time_event_ids[~has_location])
+    # Check if event has only one type of times (virtual or not). isin hashes the smaller set of virtual ids
+    physical_event_ids = time_event_ids[has_location]
+    mixed_ids = pd.unique(physical_event_ids[pd.Series(physical_event_ids).isin(virtual_ids).values])
+    if mixed_ids.shape[0]:
+        logger.info(f'Number of events that have both virtual and not virtual locations: {mixed_ids.shape[0]}')
         # Drop these events for now
-        time_new_df = time_new_df[check_virtual < 1]
-        event_new_df = event_new_df[event_new_df['id'].isin(time_new_df['raw_event_id'].unique())]
-    del check_virtual
-
-    to_replace = time_new_df.groupby('raw_event_id')['is_virtual'].mean()
-    # Add is_virtual to event table
-    event_new_df['is_virtual'] = event_new_df['id'].apply(lambda x: to_replace[x])
-    del to_replace
-    time_new_df = time_new_df.drop(columns=['is_virtual'])
-
-    # Add more virtual events
-    virtual_mask = event_new_df['title'].apply(lambda x: 'virtual' in x.lower())
-    event_new_df['is_virtual'][virtual_mask] = 1
-
-    # Add Live Stream events
-    live_mask = event_new_df['title'].apply(lambda x: 'live stream' in x.lower())
-    event_new_df['is_virtual'][live_mask] = 2
-
-    # Query price table
-    list_time_ids = time_new_df['id'].unique().tolist()
-    query_to_filter = get_filter_query(len(list_time_ids), 'raw_price', 'raw_time_id')
-    price_df = pd.read_sql_query(query_to_filter, mpdscraping_connection_event, params=list_time_ids)
-    price_df = price_df.drop_duplicates([col for col in price_df.columns if col not in ['id']])
-
-    print('Event shape:', event_new_df.shape)
-    print('Time shape', time_new_df.shape)
-    print('Price shape:', price_df.shape)
+        time_df = time_df[~time_df['raw_event_id'].isin(mixed_ids)]
+        event_df = event_df[~event_df['id'].isin(mixed_ids)]
+
+    # Titles are lowercased once for both checks
+    titles = event_df['title'].str.lower()
+    is_virtual = np.where(event_df['id'].isin(virtual_ids) | titles.str.contains('virtual', regex=False, na=False),
+                          1, 0)
+    is_virtual[titles.str.contains('live stream', regex=False, na=False).values] = 2
+    return event_df.assign(is_virtual=is_virtual.astype(np.int8)), time_df, int(mixed_ids.shape[0])
+
+
+def process_raw_data(workers: int = 1,
+                     connect: Callable[[], mysql.connector.connect] = connect_to_mpdscraping,
+                     near_duplicate_threshold: Optional[float] = None,
+                     cache: Optional[SourceCache] = None) -> Tuple[pd.DataFrame, pd.DataFrame, pd.DataFrame]:
+    """
+    Main function to process raw data.
+    Params:
+        workers: number of processes to clean sources in. Result does not depend on it, because cleaned sources
+            are merged in the same order as in serial run.
+        connect: function that opens connection to scraping DB
+        near_duplicate_threshold: if given, events with similar title_modified (MinHash similarity above threshold)
+            and the same start date and location are merged
+        cache: cache of cleaned sources, sources which raw data has not changed since they were cached are not read
+            again
+    """
+    with instrumentation.stage('process_raw_data') as metrics:
+        mpdscraping_connection_event = connect()
+
+        accumulator = SourceAccumulator(
+            event_columns=['id', 'url', 'title', 'image_url', 'description', 'source', 'is_affiliate',
+                           'title_modified'],
+            time_columns=['id', 'raw_event_id', 'start_time', 'end_time', 'location', 'processed_street_address',
+                          'postal_code', 'longitude', 'latitude', 'state'])
+
+        affiliate_sources = pd.read_sql("SELECT DISTINCT source FROM raw_event WHERE is_affiliate = '1';",
+                                        mpdscraping_connection_event)['source'].to_list()
+        other_sources = pd.read_sql("SELECT DISTINCT source FROM raw_event WHERE is_affiliate = '0';",
+                                    mpdscraping_connection_event)['source'].to_list()
+        instrumentation.add_round_trips(2)
+        # Affiliate sources go first, so their events are kept when other sources have the same events
+        sources = [(source, True) for source in affiliate_sources] + [(source, False) for source in other_sources]
+
+        if workers > 1:
+            for (source, _), cleaned in zip(sources, clean_sources_in_workers(
+                    sources, workers, connect, mpdscraping_connection_event, cache=cache)):
+                if cleaned is not None:
+                    accumulator.add(*cleaned)
+                logger.info(f"Source '{source}' processed. Number of events: {accumulator.n_events}")
+        else:
+            for source, is_affiliate in sources:
+                get_event_time_concated(source=source, is_affiliate=is_affiliate,
+                                        connection=mpdscraping_connection_event, accumulator=accumulator,
+                                        cache=cache)
+                logger.info(f"Source '{source}' processed. Number of events: {accumulator.n_events}")
+        if cache is not None:
+            metrics.extra.update(cache_hits=cache.hits, cache_misses=cache.misses)
+            logger.info(f'Source cache hits: {cache.hits}, misses: {cache.misses}')
+
+        event_new_df, time_new_df = accumulator.concat()
+        del accumulator
+
+        if near_duplicate_threshold is not None:
+            with instrumentation.stage('merge_near_duplicates') as near_duplicate_metrics:
+                near_duplicate_metrics.rows_in = event_new_df.shape[0]
+                event_new_df, time_new_df = merge_near_duplicates(event_new_df, time_new_df,
+                                                                  threshold=near_duplicate_threshold)
+                near_duplicate_metrics.rows_out = event_new_df.shape[0]
+
+        with instrumentation.stage('flag_virtual_events') as virtual_metrics:
+            virtual_metrics.rows_in = event_new_df.shape[0]
+            event_new_df, time_new_df, n_mixed = flag_virtual_events(event_new_df, time_new_df)
+            virtual_metrics.rows_out = event_new_df.shape[0]
+            virtual_metrics.extra['mixed_events'] = n_mixed
+
+        # Query price table
+        with instrumentation.stage('read_prices') as price_metrics:
+            list_time_ids = time_new_df['id'].unique().tolist()
+            price_chunks = [chunk.drop_duplicates([col for col in chunk.columns if col not in ['id']])
+                            for chunk in read_rows_by_ids(mpdscraping_connection_event, 'raw_price', 'raw_time_id',
+                                                          list_time_ids)]
+            price_df = pd.concat(price_chunks) if price_chunks else pd.DataFrame([], columns=['id', 'raw_time_id'])
+            price_df = compact_prices(price_df)
+            price_metrics.rows_out = price_df.shape[0]
+
+        logger.info(f'Event shape: {event_new_df.shape}')
+        logger.info(f'Time shape: {time_new_df.shape}')
+        logger.info(f'Price shape: {price_df.shape}')
+        metrics.rows_out = event_new_df.shape[0] + time_new_df.shape[0] + price_df.shape[0]
+        metrics.extra['memory_bytes'] = get_memory_usage({'event': event_new_df, 'time': time_new_df,
+                                                          'price': price_df})
+        logger.info(f"Memory of cleaned frames: {metrics.extra['memory_bytes'] / 2 ** 20:.1f} MB")
     return event_new_df, time_new_df, price_df
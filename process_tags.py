@@ -5,43 +5,33 @@ times in the input, because API has a minimum length threshold) to get the categ
 """
 
 from connect_to_db import connect_to_mpdprocessing_new_engine
+from tag_classification import GoogleLanguageClassifier, classify_concurrently
 from collections import defaultdict, Counter
-from google.cloud import language
-from utils import add_data
+from sqlalchemy import create_engine
+from tag_cache import TagCache
+from load_scheduler import LoadScheduler
+from typing import Optional
+from utils import add_data, translate_ids
+import instrumentation
 import pandas as pd
-import numpy as np
-import os
+import logging
 
-os.environ['GOOGLE_APPLICATION_CREDENTIALS'] = 'Eventmoon-cb642c460e65.json'
+logger = logging.getLogger(__name__)
 
 
-def classify(text: str) -> str:
-    """Classify the input text into categories"""
-    language_client = language.LanguageServiceClient()
+def explode_tags(event_df: pd.DataFrame) -> pd.DataFrame:
+    """Splits comma separated tags of events. Returns df with columns 'id' and 'tags' with a row for every tag"""
+    tags_df = event_df[['id', 'tags']].dropna(subset=['tags'])
+    return tags_df.assign(tags=tags_df['tags'].str.split(',')).explode('tags').reset_index(drop=True)
 
-    document = language.types.Document(
-        content=text,
-        type=language.enums.Document.Type.PLAIN_TEXT)
-    response = language_client.classify_text(document)
-    categories = response.categories
-    for category in categories:
-        return category.name
-    return None
 
-
-def flatten_list_column(df: pd.DataFrame, lst_col: str) -> pd.DataFrame:
-    """Flattens the column in df, which contains list objects"""
-    return pd.DataFrame({
-        col: np.repeat(df[col].values, df[lst_col].str.len())
-        for col in df.columns.drop(lst_col)}
-    ).assign(**{lst_col: np.concatenate(df[lst_col].values)})[df.columns]
-
-
-def get_cat(subcat: str, cat2subcat: dict) -> str:
-    """Gets the category name for the given subcategory"""
+def create_subcat2cat_mapping(cat2subcat: dict) -> dict:
+    """Creates mapping from subcategory to category. If subcategory is in several categories, the first is taken"""
+    subcat2cat = {}
     for cat, subcats in cat2subcat.items():
-        if subcat in subcats:
-            return cat
+        for subcat in subcats:
+            subcat2cat.setdefault(subcat, cat)
+    return subcat2cat
 
 
 def keep_frequent_tags(tags_counted: list) -> list:
@@ -55,28 +45,46 @@ def keep_frequent_tags(tags_counted: list) -> list:
 
 def create_tags2event_table(event_df: pd.DataFrame, tag_table: pd.DataFrame, tags: list) -> pd.DataFrame:
     """Creates a table with columns 'event_id' and 'tag_id' to get the connection from event to tag"""
-    tags2event_table = event_df[['id', 'tags']].dropna(subset=['tags'])
-    tags2event_table['tags'] = tags2event_table['tags'].apply(lambda x: x.split(','))
-    tags2event_table = flatten_list_column(tags2event_table, 'tags')
+    tags2event_table = explode_tags(event_df)
     tags2event_table['tags'] = tags2event_table['tags'].str.strip().str.lower()
     tags2event_table = tags2event_table[tags2event_table['tags'].isin(tags)]
 
-    tag_table_index = tag_table.set_index('tag')
-    tags2event_table['tags'] = tags2event_table['tags'].apply(lambda x: tag_table_index.loc[x, 'id'])
+    tags2event_table['tags'] = tags2event_table['tags'].map(tag_table.set_index('tag')['id'])
     tags2event_table = tags2event_table.rename(columns={'id': 'event_id', 'tags': 'tag_id'})
     return tags2event_table
 
 
-def classify_tags(tags: list) -> dict:
-    """Classifies tag names to get unique categories (Google API is used)"""
-    # Classify tags
-    subcat2tag = {}
-    for tag_to_check in tags:
-        res = classify(' '.join([tag_to_check for _ in range(30)]))
-        subcat2tag[tag_to_check] = res.strip('/').split('/') if res else res
-
-    # Filter subcat2tag
-    subcat2tag = {tag_real: tag_new for tag_real, tag_new in subcat2tag.items() if tag_new is not None}
+def classify_tags(tags: list, classifier=None, cache: Optional[TagCache] = None, max_workers: int = 8,
+                  requests_per_second: Optional[float] = 10) -> dict:
+    """
+    Classifies tag names to get unique categories (Google API is used by default).
+    If cache is given, only tags missing in the cache are sent to the classifier and every classified tag is saved
+    to the cache at once.
+    Requests are made in max_workers threads with rate limited to requests_per_second.
+    """
+    with instrumentation.stage('classify_tags') as metrics:
+        metrics.rows_in = len(tags)
+        categories = cache.get_many(tags) if cache is not None else {}
+        if cache is not None:
+            metrics.extra.update(cache_hits=len(categories), cache_misses=len(tags) - len(categories))
+            logger.info(f'Tag cache hits: {len(categories)}, misses: {len(tags) - len(categories)}')
+
+        # Classify tags
+        tags_to_classify = [tag for tag in tags if tag not in categories]
+        if tags_to_classify and classifier is None:
+            classifier = GoogleLanguageClassifier()
+        categories.update(classify_concurrently(tags_to_classify, classifier, max_workers=max_workers,
+                                                requests_per_second=requests_per_second,
+                                                on_result=cache.set if cache is not None else None))
+
+        subcat2tag = {}
+        for tag_to_check in tags:
+            res = categories[tag_to_check]
+            subcat2tag[tag_to_check] = res.strip('/').split('/') if res else res
+
+        # Filter subcat2tag
+        subcat2tag = {tag_real: tag_new for tag_real, tag_new in subcat2tag.items() if tag_new is not None}
+        metrics.rows_out = len(subcat2tag)
 
     return subcat2tag
 
@@ -121,8 +129,9 @@ def create_cat2subcat_table(subcategory_table: pd.DataFrame, category_table: pd.
     """Creates a category_subcategory table with columns 'category_id' and 'subcategory_id' to latter push to DB"""
     cat2subcat_table = subcategory_table.rename(columns={'id': 'subcategory_id'})
 
-    cat2subcat_table['category_id'] = cat2subcat_table['subcategory'].apply(
-        lambda x: category_table[category_table['category'] == get_cat(x, cat2subcat)]['id'].iloc[0])
+    cat2subcat_table['category_id'] = cat2subcat_table['subcategory'] \
+        .map(create_subcat2cat_mapping(cat2subcat)) \
+        .map(category_table.set_index('category')['id'])
 
     return cat2subcat_table.drop(columns=['subcategory'])
 
@@ -130,33 +139,43 @@ def create_cat2subcat_table(subcategory_table: pd.DataFrame, category_table: pd.
 def create_subcat2tag_table(subcategory_table: pd.DataFrame, tag_table: pd.DataFrame, subcat2tag: dict) -> pd.DataFrame:
     """Creates a subcategory_tag table with columns 'tag_id' and 'subcategory_id' to latter push to DB"""
     subcat2tag_table = tag_table.rename(columns={'id': 'tag_id'})
-    subcat2tag_table['subcats'] = subcat2tag_table['tag'].apply(lambda x: subcat2tag[x])
+    subcat2tag_table['subcats'] = subcat2tag_table['tag'].map(subcat2tag)
 
-    subcat2tag_table = flatten_list_column(subcat2tag_table, 'subcats')
+    subcat2tag_table = subcat2tag_table.explode('subcats').reset_index(drop=True)
 
-    subcat_table_index = subcategory_table.set_index('subcategory')
-    subcat2tag_table['subcats'] = subcat2tag_table['subcats'].apply(lambda x: subcat_table_index.loc[x, 'id'])
-    del subcat_table_index
+    subcat2tag_table['subcats'] = subcat2tag_table['subcats'].map(subcategory_table.set_index('subcategory')['id'])
     subcat2tag_table = subcat2tag_table.drop(columns=['tag'])
 
     return subcat2tag_table.rename(columns={'id': 'tag_id', 'subcats': 'subcategory_id'})
 
 
-def process_tags(event_df: pd.DataFrame, event2time: dict) -> None:
+def get_tags_to_check(event_df: pd.DataFrame) -> list:
+    """Gets frequent tags of events, ordered by frequency. Numeric tags are skipped"""
+    tags = explode_tags(event_df)['tags']
+    tags = tags[~tags.str.strip('< ').str.isdigit()].str.strip().str.lower()
+    tags_counted = Counter(tags.tolist()).most_common()
+    tags_to_check = keep_frequent_tags(tags_counted)
+    logger.info(f'Unique tags to process: {len(tags_to_check)}')
+    return tags_to_check
+
+
+def push_tags(event_df: pd.DataFrame, event2time: pd.Series, subcat2tag: dict, loaders: Optional[dict] = None,
+              connection: Optional[create_engine] = None, table_suffix: str = '', load_workers: int = 4) -> None:
     """
-    Main function to process tags.
-    It takes tags, fillters them, classifies them, gets category and subcategories for each tag and pushes related
-    tables to DB.
+    Creates tag, category and subcategory tables and their mapping tables from classified tags and pushes them
+    to DB. Tag, category and subcategory tables are pushed at the same time, every mapping table is pushed as soon
+    as the tables it points to are pushed (see load_scheduler).
+    Params:
+        event2time: mapping from ids of events to ids in processing DB
+        subcat2tag: mapping from tag to its category path, as returned by classify_tags
+        loaders: mapping from table name to loader used to push it (see add_data), 'to_sql' is used by default
+        connection: SQLAlchemy engine of processing DB, it is created if not given
+        table_suffix: suffix of tables to push data to, e.g. '_new' to push to shadow tables (see publish)
+        load_workers: number of tables pushed at the same time
     """
-    connection = connect_to_mpdprocessing_new_engine()
+    connection = connection or connect_to_mpdprocessing_new_engine()
+    loaders = loaders or {}
 
-    tags = event_df['tags'].dropna().apply(lambda x: x.split(',')).tolist()
-    tags = [tag.strip().lower() for tags_event in tags for tag in tags_event if not tag.strip('< ').isdigit()]
-    tags_counted = Counter(tags).most_common()
-    tags_to_check = keep_frequent_tags(tags_counted)
-    print(f'Unique tags to process: {len(tags_to_check)}')
-
-    subcat2tag = classify_tags(tags_to_check)
     final_tags = list(subcat2tag.keys())
     tag_table = create_tag_table(final_tags)
     tags2event_table = create_tags2event_table(event_df, tag_table, final_tags)
@@ -172,23 +191,60 @@ def process_tags(event_df: pd.DataFrame, event2time: dict) -> None:
     subcategory_table = subcategory_table.rename(columns={'subcategory': 'name'})
     category_table = category_table.rename(columns={'category': 'name'})
 
+    scheduler = LoadScheduler('tags', max_workers=load_workers)
     # Add tag, subcategory, category and get mappings
-    tag_id_mapping = add_data(df=tag_table, sql_table_name='tag', connection=connection)
-    subcategory_id_mapping = add_data(df=subcategory_table, sql_table_name='subcategory', connection=connection)
-    category_id_mapping = add_data(df=category_table, sql_table_name='category', connection=connection)
-
-    # Map ids to ids in database
-    tags2event_table['tag_id'] = tags2event_table['tag_id'].apply(lambda x: tag_id_mapping[x])
-    tags2event_table['event_id'] = tags2event_table['event_id'].apply(lambda x: event2time[x])
-
-    subcat2tag_table['subcategory_id'] = subcat2tag_table['subcategory_id'].apply(lambda x: subcategory_id_mapping[x])
-    subcat2tag_table['tag_id'] = subcat2tag_table['tag_id'].apply(lambda x: tag_id_mapping[x])
-
-    cat2subcat_table['category_id'] = cat2subcat_table['category_id'].apply(lambda x: category_id_mapping[x])
-    cat2subcat_table['subcategory_id'] = cat2subcat_table['subcategory_id'].apply(lambda x: subcategory_id_mapping[x])
-
-    # Add mapping tables to have connection among tables
-    add_data(df=tags2event_table, sql_table_name='tag__event', connection=connection, return_mapping=False)
-    add_data(df=subcat2tag_table, sql_table_name='subcategory__tag', connection=connection, return_mapping=False)
-    add_data(df=cat2subcat_table, sql_table_name='category__subcategory', connection=connection, return_mapping=False)
-    print('Finished')
+    for table_name, table in [('tag', tag_table), ('subcategory', subcategory_table), ('category', category_table)]:
+        scheduler.add(table_name, lambda inputs, table_name=table_name, table=table: add_data(
+            df=table, sql_table_name=table_name + table_suffix, connection=connection,
+            loader=loaders.get(table_name, 'to_sql')))
+
+    # Map ids to ids in database and add mapping tables to have connection among tables
+    def push_tags2event(inputs: dict) -> None:
+        tags2event_table['tag_id'] = translate_ids(tags2event_table['tag_id'], inputs['tag'], 'tag ids')
+        tags2event_table['event_id'] = translate_ids(tags2event_table['event_id'], event2time, 'event ids')
+        add_data(df=tags2event_table, sql_table_name='tag__event' + table_suffix, connection=connection,
+                 return_mapping=False, loader=loaders.get('tag__event', 'to_sql'))
+
+    def push_subcat2tag(inputs: dict) -> None:
+        subcat2tag_table['subcategory_id'] = translate_ids(subcat2tag_table['subcategory_id'], inputs['subcategory'],
+                                                           'subcategory ids')
+        subcat2tag_table['tag_id'] = translate_ids(subcat2tag_table['tag_id'], inputs['tag'], 'tag ids')
+        add_data(df=subcat2tag_table, sql_table_name='subcategory__tag' + table_suffix, connection=connection,
+                 return_mapping=False, loader=loaders.get('subcategory__tag', 'to_sql'))
+
+    def push_cat2subcat(inputs: dict) -> None:
+        cat2subcat_table['category_id'] = translate_ids(cat2subcat_table['category_id'], inputs['category'],
+                                                        'category ids')
+        cat2subcat_table['subcategory_id'] = translate_ids(cat2subcat_table['subcategory_id'], inputs['subcategory'],
+                                                           'subcategory ids')
+        add_data(df=cat2subcat_table, sql_table_name='category__subcategory' + table_suffix, connection=connection,
+                 return_mapping=False, loader=loaders.get('category__subcategory', 'to_sql'))
+
+    scheduler.add('tag__event', push_tags2event, dependencies=['tag'])
+    scheduler.add('subcategory__tag', push_subcat2tag, dependencies=['subcategory', 'tag'])
+    scheduler.add('category__subcategory', push_cat2subcat, dependencies=['category', 'subcategory'])
+    scheduler.run()
+    logger.info('Finished')
+
+
+def process_tags(event_df: pd.DataFrame, event2time: pd.Series, classifier=None, cache: Optional[TagCache] = None,
+                 classify_workers: int = 8, classify_rate: Optional[float] = 10,
+                 loaders: Optional[dict] = None, connection: Optional[create_engine] = None,
+                 load_workers: int = 4) -> None:
+    """
+    Main function to process tags.
+    It takes tags, fillters them, classifies them, gets category and subcategories for each tag and pushes related
+    tables to DB.
+    Params:
+        classifier: object with classify(tag) method, Google API is used if it is not given
+        cache: cache of classification results
+        classify_workers: number of concurrent requests to classifier
+        classify_rate: maximum number of requests to classifier per second
+        loaders: mapping from table name to loader used to push it (see add_data), 'to_sql' is used by default
+        connection: SQLAlchemy engine of processing DB, it is created if not given
+        load_workers: number of tables pushed at the same time
+    """
+    tags_to_check = get_tags_to_check(event_df)
+    subcat2tag = classify_tags(tags_to_check, classifier=classifier, cache=cache, max_workers=classify_workers,
+                               requests_per_second=classify_rate)
+    push_tags(event_df, event2time, subcat2tag, loaders=loaders, connection=connection, load_workers=load_workers)
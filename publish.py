@@ -0,0 +1,130 @@
+"""
+Module is used to publish new data to processing DB without downtime.
+Data is loaded into shadow tables (event_new, time_new, ...) created like the live tables. Secondary indexes are
+dropped from shadow tables before the load and built after it, except the index of raw_id, which is used to
+resolve ids of every pushed chunk during the load (see utils.get_id_mapping). Then all the live tables are
+swapped with shadow ones by one RENAME TABLE statement, which is atomic in MySQL, so readers see either old or new
+data.
+Replaced tables are kept as old generations (event_old_<generation>, ...) to roll back to them, only the latest
+ones are kept.
+Note that CREATE TABLE ... LIKE does not copy foreign keys and starts AUTO_INCREMENT from 1.
+"""
+
+from sqlalchemy import create_engine, inspect, text
+from typing import Optional
+import instrumentation
+import datetime
+import logging
+import re
+
+logger = logging.getLogger(__name__)
+
+SHADOW_SUFFIX = '_new'
+OLD_SUFFIX = '_old_'
+
+
+def get_secondary_indexes(table_name: str, engine: create_engine) -> list:
+    """Gets indexes of the table except primary key. Every index is dict with 'name', 'column_names' and 'unique'"""
+    return inspect(engine).get_indexes(table_name)
+
+
+def prepare_shadow_tables(tables: list, engine: create_engine) -> None:
+    """
+    Creates empty shadow tables like the live ones. Shadow tables left by a previous failed publish are replaced.
+    Secondary indexes are dropped, to be built after the load by build_indexes. Index of raw_id is kept, because
+    ids of pushed rows are looked up by it during the load.
+    """
+    with engine.begin() as db_connection:
+        for table_name in tables:
+            shadow_name = table_name + SHADOW_SUFFIX
+            db_connection.execute(text(f'DROP TABLE IF EXISTS {shadow_name}'))
+            db_connection.execute(text(f'CREATE TABLE {shadow_name} LIKE {table_name}'))
+    for table_name in tables:
+        shadow_name = table_name + SHADOW_SUFFIX
+        with engine.begin() as db_connection:
+            for index in get_secondary_indexes(shadow_name, engine):
+                if index['column_names'] == ['raw_id']:
+                    continue
+                db_connection.execute(text(f"ALTER TABLE {shadow_name} DROP INDEX {index['name']}"))
+    logger.info(f'Shadow tables are created: {", ".join(table + SHADOW_SUFFIX for table in tables)}')
+
+
+def build_indexes(tables: list, engine: create_engine) -> None:
+    """Creates indexes of live tables that are missing in shadow tables. All indexes of a table are built at once"""
+    for table_name in tables:
+        shadow_name = table_name + SHADOW_SUFFIX
+        existing = {index['name'] for index in get_secondary_indexes(shadow_name, engine)}
+        additions = [f"ADD {'UNIQUE ' if index['unique'] else ''}INDEX {index['name']} "
+                     f"({', '.join(index['column_names'])})"
+                     for index in get_secondary_indexes(table_name, engine) if index['name'] not in existing]
+        if additions:
+            with instrumentation.stage('build_indexes', table=shadow_name):
+                with engine.begin() as db_connection:
+                    db_connection.execute(text(f'ALTER TABLE {shadow_name} {", ".join(additions)}'))
+
+
+def get_generations(tables: list, engine: create_engine) -> list:
+    """Gets old generations that are kept for all the tables, from the latest to the oldest"""
+    table_names = set(inspect(engine).get_table_names())
+    generations = None
+    for table_name in tables:
+        pattern = re.compile(re.escape(table_name + OLD_SUFFIX) + r'(\d+)$')
+        table_generations = {match.group(1) for match in map(pattern.match, table_names) if match}
+        generations = table_generations if generations is None else generations & table_generations
+    return sorted(generations or [], reverse=True)
+
+
+def swap_tables(tables: list, engine: create_engine, generation: str) -> None:
+    """Replaces live tables with shadow ones in one statement. Live tables become the old generation"""
+    renames = []
+    for table_name in tables:
+        renames.append(f'{table_name} TO {table_name}{OLD_SUFFIX}{generation}')
+        renames.append(f'{table_name}{SHADOW_SUFFIX} TO {table_name}')
+    with engine.begin() as db_connection:
+        db_connection.execute(text(f'RENAME TABLE {", ".join(renames)}'))
+    instrumentation.add_round_trips()
+    logger.info(f'Tables are swapped, previous data is kept as generation {generation}')
+
+
+def drop_old_generations(tables: list, engine: create_engine, keep: int) -> None:
+    """Drops old generations except the latest keep ones"""
+    for generation in get_generations(tables, engine)[keep:]:
+        with engine.begin() as db_connection:
+            db_connection.execute(text(
+                f'DROP TABLE IF EXISTS {", ".join(table + OLD_SUFFIX + generation for table in tables)}'))
+        logger.info(f'Generation {generation} is dropped')
+
+
+def publish(tables: list, engine: create_engine, keep: int = 2, generation: Optional[str] = None) -> str:
+    """
+    Builds indexes of loaded shadow tables, swaps them with live tables and drops too old generations.
+    Returns:
+        Generation name of replaced data
+    """
+    generation = generation or datetime.datetime.now().strftime('%Y%m%d%H%M%S')
+    build_indexes(tables, engine)
+    swap_tables(tables, engine, generation)
+    drop_old_generations(tables, engine, keep)
+    return generation
+
+
+def rollback(tables: list, engine: create_engine) -> str:
+    """
+    Swaps live tables with the latest old generation in one statement. Live tables become shadow tables, so
+    they are dropped by the next publish.
+    Returns:
+        Generation that is live now
+    """
+    generations = get_generations(tables, engine)
+    if not generations:
+        raise ValueError('There is no old generation to roll back to')
+    generation = generations[0]
+    renames = []
+    for table_name in tables:
+        renames.append(f'{table_name} TO {table_name}{SHADOW_SUFFIX}')
+        renames.append(f'{table_name}{OLD_SUFFIX}{generation} TO {table_name}')
+    with engine.begin() as db_connection:
+        db_connection.execute(text(f'DROP TABLE IF EXISTS {", ".join(table + SHADOW_SUFFIX for table in tables)}'))
+        db_connection.execute(text(f'RENAME TABLE {", ".join(renames)}'))
+    logger.info(f'Rolled back to generation {generation}')
+    return generation
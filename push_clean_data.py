@@ -3,42 +3,104 @@ Module is used to push cleaned data to processing DB
 """
 
 import pandas as pd
+import numpy as np
 from connect_to_db import connect_to_mpdprocessing_new_engine
-from utils import add_data
+from load_scheduler import LoadScheduler
+from sqlalchemy import create_engine
+from typing import Iterator, Optional
+from utils import add_data, format_datetimes, translate_ids, UnmappedIdsError
+import math
 
 
-def push_clean_data(event_df: pd.DataFrame, time_df: pd.DataFrame, price_df: pd.DataFrame) -> dict:
+def format_time_columns(time_df: pd.DataFrame) -> pd.DataFrame:
+    """Prepares time rows to be pushed: renames foreign key and converts datetime columns to strings"""
+    return time_df.rename(columns={'raw_event_id': 'event_id'}).assign(
+        start_time=format_datetimes(time_df['start_time']),
+        end_time=format_datetimes(time_df['end_time']))
+
+
+def split_prices_by_time_chunks(price_df: pd.DataFrame, time_df: pd.DataFrame, chunk_size: int) -> list:
+    """
+    Splits prices by the chunks of times (consecutive slices of chunk_size rows) their times are in, so they are
+    pushed as soon as their chunk of times is pushed. Order of prices in every chunk is kept.
+    Raises UnmappedIdsError if some prices have no time.
+    """
+    positions = pd.Index(time_df['id']).get_indexer(price_df['raw_time_id'].values)
+    if (positions < 0).any():
+        raise UnmappedIdsError('time ids', pd.unique(price_df['raw_time_id'].values[positions < 0]).tolist())
+    time_chunks = positions // chunk_size
+    order = np.argsort(time_chunks, kind='stable')
+    bounds = np.searchsorted(time_chunks[order], np.arange(math.ceil(time_df.shape[0] / chunk_size) + 1))
+    return [price_df.iloc[order[begin:end]] for begin, end in zip(bounds[:-1], bounds[1:])]
+
+
+def format_time_chunks(time_df: pd.DataFrame, event2time: pd.Series, chunk_size: int) -> Iterator[pd.DataFrame]:
+    """Translates event ids of times to ids in DB and formats times chunk by chunk"""
+    for start in range(0, time_df.shape[0], chunk_size):
+        time_chunk = time_df.iloc[start:start + chunk_size]
+        time_chunk = time_chunk.assign(raw_event_id=translate_ids(time_chunk['raw_event_id'], event2time, 'event ids'))
+        yield format_time_columns(time_chunk)
+
+
+def push_time_chunks(time_chunks: Iterator[pd.DataFrame], sql_table_name: str, connection: create_engine,
+                     loader: str) -> Iterator[pd.Series]:
+    """Pushes chunks of times and yields mapping of ids of every chunk as soon as it is pushed"""
+    for time_chunk in time_chunks:
+        yield add_data(df=time_chunk, sql_table_name=sql_table_name, connection=connection, batch_size=5000,
+                       return_mapping=True, loader=loader)
+
+
+def push_price_chunks(time_mappings: Iterator[pd.Series], price_chunks: list, sql_table_name: str,
+                      connection: create_engine, loader: str) -> None:
+    """Pushes prices of every chunk of times as soon as mapping of its ids is given"""
+    for time2price, price_chunk in zip(time_mappings, price_chunks):
+        if price_chunk.shape[0] == 0:
+            continue
+        price_chunk = price_chunk.assign(raw_time_id=translate_ids(price_chunk['raw_time_id'], time2price,
+                                                                   'time ids'))
+        price_chunk = price_chunk.rename(columns={'raw_time_id': 'time_id'}).drop(columns=['id'])
+        add_data(df=price_chunk, sql_table_name=sql_table_name, connection=connection, batch_size=5000,
+                 return_mapping=False, loader=loader)
+
+
+def push_clean_data(event_df: pd.DataFrame, time_df: pd.DataFrame, price_df: pd.DataFrame,
+                    loaders: Optional[dict] = None, connection: Optional[create_engine] = None,
+                    table_suffix: str = '', load_workers: int = 4, chunk_size: int = 100000) -> pd.Series:
     """
     Pushes clean data to processing DB.
+    Times are pushed in chunks as soon as events are pushed, and prices of every chunk of times are pushed as soon
+    as the chunk is pushed, while the next chunk is formatted and pushed (see load_scheduler).
     Params:
         event_df: processed data from raw_event table in Scraping DB
         time_df: processed data from raw_time table in Scraping DB
         price_df: processed data from raw_price table in Scraping DB
+        loaders: mapping from table name to loader used to push it (see add_data), 'to_sql' is used by default
+        connection: SQLAlchemy engine of processing DB, it is created if not given
+        table_suffix: suffix of tables to push data to, e.g. '_new' to push to shadow tables (see publish)
+        load_workers: number of tables loaded at the same time, with 1 chunks are formatted and pushed one after
+            another
+        chunk_size: number of times in a chunk
     Returns:
         Mapping from old ids from scraping event table to new ids from processed event table
     """
-    mpdprocessing_new_connection = connect_to_mpdprocessing_new_engine()
+    mpdprocessing_new_connection = connection or connect_to_mpdprocessing_new_engine()
+    loaders = loaders or {}
+    price_chunks = split_prices_by_time_chunks(price_df, time_df, chunk_size)
 
+    scheduler = LoadScheduler('clean_data', max_workers=load_workers)
     # Push event data
-    event2time = add_data(df=event_df.drop(columns=['tags']), sql_table_name='event',
-                          connection=mpdprocessing_new_connection, batch_size=5000,
-                          return_mapping=True)
-
-    # Push time data
-    time_df['raw_event_id'] = time_df['raw_event_id'].apply(lambda x: event2time[x])
-    time_new_df = time_df.rename(columns={'raw_event_id': 'event_id'})
-    time_new_df.loc[:, ['start_time', 'end_time']] = time_new_df.loc[:, ['start_time', 'end_time']].applymap(
-        lambda x: x.strftime('%Y-%m-%d %H:%M:%S') if pd.notna(x) else None)
-
-    time2price = add_data(df=time_new_df, sql_table_name='time', connection=mpdprocessing_new_connection,
-                          batch_size=5000, return_mapping=True)
-
-    # Push price data
-    price_df['raw_time_id'] = price_df['raw_time_id'].apply(lambda x: time2price[x])
-    price_df = price_df.rename(columns={'raw_time_id': 'time_id'})
-    price_df = price_df.drop(columns=['id'])
-
-    add_data(df=price_df, sql_table_name='price', connection=mpdprocessing_new_connection, batch_size=5000,
-             return_mapping=False)
-
-    return event2time
+    scheduler.add('event', lambda inputs: add_data(
+        df=event_df.drop(columns=['tags']), sql_table_name='event' + table_suffix,
+        connection=mpdprocessing_new_connection, batch_size=5000, return_mapping=True,
+        loader=loaders.get('event', 'to_sql')))
+    # Push time data chunk by chunk
+    scheduler.add('format_time', lambda inputs: format_time_chunks(time_df, inputs['event'], chunk_size),
+                  dependencies=['event'])
+    scheduler.add('time', lambda inputs: push_time_chunks(
+        inputs['format_time'], 'time' + table_suffix, mpdprocessing_new_connection, loaders.get('time', 'to_sql')),
+        stream_from='format_time')
+    # Push price data of every pushed chunk of times
+    scheduler.add('price', lambda inputs: push_price_chunks(
+        inputs['time'], price_chunks, 'price' + table_suffix, mpdprocessing_new_connection,
+        loaders.get('price', 'to_sql')), stream_from='time')
+    return scheduler.run()['event']
@@ -4,7 +4,16 @@ It is done before updating the DB with new data.
 """
 
 from connect_to_db import connect_to_mpdprocessing_new
+import instrumentation
 import mysql.connector
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Tables filled by process_tags. Ordered so that mapping tables are deleted before the tables they point to.
+TAG_TABLES = ['tag__event', 'subcategory__tag', 'category__subcategory', 'tag', 'subcategory', 'category']
+ALL_TABLES = ['event', 'time', 'price', 'tag', 'subcategory', 'category', 'tag__event', 'subcategory__tag',
+              'category__subcategory']
 
 
 def delete_data_in_table(cursor: mysql.connector.connect, connection: mysql.connector.connect,
@@ -16,23 +25,54 @@ def delete_data_in_table(cursor: mysql.connector.connect, connection: mysql.conn
         connection: MySQL connection
         table_name: table name to delete data from
     """
-    sql = f"DELETE FROM {table_name}"
-    cursor.execute(sql)
+    with instrumentation.stage('delete_data', table=table_name) as metrics:
+        sql = f"DELETE FROM {table_name}"
+        cursor.execute(sql)
+        connection.commit()
+        instrumentation.add_round_trips(2)
+        metrics.rows_out = cursor.rowcount
+    logger.info(f'Deleted {table_name} table rows')
+
+
+def delete_rows_by_id(cursor: mysql.connector.connect, connection: mysql.connector.connect, table_name: str,
+                      ids: list, batch_size: int = 5000, id_column: str = 'id', where: str = '',
+                      params: tuple = ()) -> None:
+    """
+    Deletes rows with given ids from table.
+    Params:
+        cursor: cursor object
+        connection: MySQL connection
+        table_name: table name to delete rows from
+        ids: ids of rows to delete
+        batch_size: number of ids to delete in one query
+        id_column: column to match ids against
+        where: additional condition ('and ...') used together with params
+    """
+    for start in range(0, len(ids), batch_size):
+        batch = [int(x) for x in ids[start:start + batch_size]]
+        placeholders = ', '.join('%s' for _ in batch)
+        cursor.execute(f"DELETE FROM {table_name} WHERE {id_column} in ({placeholders}) {where}",
+                       batch + list(params))
+        instrumentation.add_round_trips()
     connection.commit()
-    print(f'Deleted {table_name} table rows')
+    logger.info(f'Deleted {len(ids)} {table_name} table rows')
 
 
-def delete_data_in_all_tables() -> None:
+def delete_data_in_tables(tables_to_delete_data: list) -> None:
     """
-    Deletes data from all tables in processing DB
+    Deletes data from given tables in processing DB
     """
     mpdprocessing_new_connection = connect_to_mpdprocessing_new()
     cursor = mpdprocessing_new_connection.cursor()
 
-    tables_to_delete_data = ['event', 'time', 'price', 'tag', 'subcategory', 'category', 'tag__event',
-                             'subcategory__tag', 'category__subcategory']
-
     for table_to_delete_data in tables_to_delete_data:
         delete_data_in_table(cursor, mpdprocessing_new_connection, table_to_delete_data)
 
     cursor.close()
+
+
+def delete_data_in_all_tables() -> None:
+    """
+    Deletes data from all tables in processing DB
+    """
+    delete_data_in_tables(ALL_TABLES)
@@ -0,0 +1,99 @@
+"""
+Module is used to cache cleaned data of scraping sources between runs, so unchanged sources are not read and
+cleaned again.
+Entry of a source is used only if the fingerprint of its raw data (see read_source_fingerprint) and the version of
+cleaning code are the same as when it was saved. Fingerprint changes when rows of the source are added or
+deleted, but not when they are updated in place, so the cache has to be cleared if scraper updates rows.
+Entries of other cleaning versions are removed when the cache is opened. Size of the cache on disk is limited,
+least recently used entries are evicted.
+"""
+
+from artifacts import read_frame, write_frame, write_json
+from typing import Optional, Tuple
+import pandas as pd
+import hashlib
+import logging
+import json
+import time
+import os
+
+logger = logging.getLogger(__name__)
+
+INDEX = 'index.json'
+
+
+class SourceCache:
+    """Directory with cleaned events and times of sources. Index keeps key, size and last use of every entry"""
+
+    def __init__(self, directory: str, version: int, max_bytes: int = 2 ** 31):
+        self.directory = directory
+        self.version = version
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(directory, exist_ok=True)
+        index_path = os.path.join(directory, INDEX)
+        if os.path.exists(index_path):
+            with open(index_path) as index:
+                self.index = json.load(index)
+        else:
+            self.index = {'entries': {}}
+        outdated = [name for name, entry in self.index['entries'].items() if entry['version'] != version]
+        for name in outdated:
+            self.remove(name)
+        if outdated:
+            logger.info(f'Removed {len(outdated)} cached sources of previous cleaning versions')
+            self.write_index()
+
+    def write_index(self) -> None:
+        """Writes index to the directory"""
+        write_json(self.index, os.path.join(self.directory, INDEX))
+
+    def get_paths(self, name: str) -> Tuple[str, str]:
+        """Gets paths of event and time files of the entry. Names of sources are hashed to be safe file names"""
+        file_name = hashlib.sha1(name.encode('utf-8')).hexdigest()
+        return (os.path.join(self.directory, f'{file_name}.event.parquet'),
+                os.path.join(self.directory, f'{file_name}.time.parquet'))
+
+    def contains(self, name: str, key: list) -> bool:
+        """Checks if the entry is saved with the same key"""
+        entry = self.index['entries'].get(name)
+        return entry is not None and entry['key'] == key and all(map(os.path.exists, self.get_paths(name)))
+
+    def get(self, name: str, key: list) -> Optional[Tuple[pd.DataFrame, pd.DataFrame]]:
+        """Gets events and times of the entry or None if it is missing or its key has changed"""
+        if not self.contains(name, key):
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.index['entries'][name]['last_used'] = time.time()
+        self.write_index()
+        event_path, time_path = self.get_paths(name)
+        return read_frame(event_path), read_frame(time_path)
+
+    def put(self, name: str, key: list, event_df: pd.DataFrame, time_df: pd.DataFrame) -> None:
+        """Saves events and times of the entry and evicts least recently used entries over the size limit"""
+        event_path, time_path = self.get_paths(name)
+        size = write_frame(event_df, event_path) + write_frame(time_df, time_path)
+        self.index['entries'][name] = {'key': key, 'version': self.version, 'bytes': size, 'last_used': time.time()}
+        self.evict(keep=name)
+        self.write_index()
+
+    def remove(self, name: str) -> None:
+        """Removes the entry and its files"""
+        self.index['entries'].pop(name, None)
+        for path in self.get_paths(name):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def evict(self, keep: Optional[str] = None) -> None:
+        """Removes least recently used entries until the cache fits into its size. The kept entry is not removed"""
+        entries = self.index['entries']
+        total = sum(entry['bytes'] for entry in entries.values())
+        for name in sorted(entries, key=lambda name: entries[name]['last_used']):
+            if total <= self.max_bytes:
+                break
+            if name != keep:
+                total -= entries[name]['bytes']
+                self.remove(name)
+                logger.info(f'Evicted cached source {name}')
@@ -0,0 +1,85 @@
+"""
+Module is used to read raw data from scraping DB in bounded chunks.
+Tables are read with keyset pagination over 'id' column, and lookups by a list of ids are split into batches,
+so neither the query size nor the size of a single result grows with the scraping DB.
+"""
+
+from instrumentation import add_read
+from typing import Iterator
+import mysql.connector
+import pandas as pd
+import sqlite3
+
+PAGE_SIZE = 50000
+ID_BATCH_SIZE = 1000
+
+
+def read_sql_query(query: str, connection: mysql.connector.connect, params: list) -> pd.DataFrame:
+    """Runs the query and adds the result to running stages. Size of the result is measured in memory"""
+    df = pd.read_sql_query(query, connection, params=params)
+    add_read(df.shape[0], int(df.memory_usage(deep=True).sum()))
+    return df
+
+
+def get_placeholder(connection: mysql.connector.connect) -> str:
+    """Gets placeholder of query parameters for the connection ('?' for SQLite, '%s' for MySQL)"""
+    return '?' if isinstance(connection, sqlite3.Connection) else '%s'
+
+
+def get_filter_query(filter_list_num: int, table_name: str, column_name: str, placeholder: str = '%s') -> str:
+    """Creates command to use it to query DB and get needed data"""
+    placeholders = ', '.join(placeholder for _ in range(filter_list_num))
+    query_to_filter = f'select * from {table_name} where {column_name} in (%s)' % placeholders
+    return query_to_filter
+
+
+def read_table_in_pages(connection: mysql.connector.connect, table_name: str, column_name: str, value,
+                        page_size: int = PAGE_SIZE) -> Iterator[pd.DataFrame]:
+    """
+    Reads rows of the table which column is equal to value page by page in order of ids.
+    Params:
+        connection: MySQL connection
+        table_name: table name to read data from
+        column_name: column to filter rows by
+        value: value of the column
+        page_size: maximum number of rows in one page
+    """
+    placeholder = get_placeholder(connection)
+    query = f'select * from {table_name} where {column_name} = {placeholder} and id > {placeholder} ' \
+            f'order by id limit {placeholder}'
+    last_id = -1
+    while True:
+        page = read_sql_query(query, connection, params=[value, last_id, page_size])
+        if page.shape[0] == 0:
+            return
+        yield page
+        if page.shape[0] < page_size:
+            return
+        last_id = int(page['id'].iloc[-1])
+
+
+def read_rows_by_ids(connection: mysql.connector.connect, table_name: str, column_name: str, ids: list,
+                     batch_size: int = ID_BATCH_SIZE) -> Iterator[pd.DataFrame]:
+    """
+    Reads rows of the table which column value is in ids. Ids are queried in batches.
+    All the rows with the same column value are returned in the same chunk.
+    """
+    placeholder = get_placeholder(connection)
+    for start in range(0, len(ids), batch_size):
+        batch = ids[start:start + batch_size]
+        yield read_sql_query(get_filter_query(len(batch), table_name, column_name, placeholder), connection,
+                             params=batch)
+
+
+def read_source_fingerprint(connection: mysql.connector.connect, source: str) -> list:
+    """
+    Reads cheap fingerprint of raw data of the source: number of rows, maximum and sum of ids of its events and
+    of their times. Only indexes are read to compute it.
+    """
+    placeholder = get_placeholder(connection)
+    events = read_sql_query(f'select count(*), max(id), sum(id) from raw_event where source = {placeholder}',
+                            connection, params=[source])
+    times = read_sql_query('select count(*), max(t.id), sum(t.id) from raw_time t '
+                           f'join raw_event e on t.raw_event_id = e.id where e.source = {placeholder}',
+                           connection, params=[source])
+    return [None if pd.isna(value) else int(value) for value in events.iloc[0].tolist() + times.iloc[0].tolist()]
@@ -0,0 +1,227 @@
+"""
+Module is used to incrementally sync cleaned data to processing DB.
+Every cleaned row is fingerprinted and compared with the ledger saved by the previous sync. The ledger keeps
+mapping from raw ids of scraping DB to ids of processing DB, so only new rows are inserted, changed rows are
+updated and vanished rows are deleted.
+New rows and their ledger entries are written one after another. If sync fails between them, the rows are found
+by their raw_id column on the next sync and updated instead of being inserted again.
+"""
+
+from connect_to_db import connect_to_mpdprocessing_new, connect_to_mpdprocessing_new_engine
+from push_clean_data import format_time_columns
+from remove_tables import delete_data_in_table, delete_rows_by_id
+from bulk_load import to_db_rows
+from utils import add_data, check_raw_id_column, fingerprint_rows, read_ids_by_raw_ids, translate_ids
+from sqlalchemy import create_engine, inspect, text
+from typing import Optional, Tuple
+import instrumentation
+import mysql.connector
+import pandas as pd
+import logging
+
+logger = logging.getLogger(__name__)
+
+LEDGER_TABLE = 'raw_id_ledger'
+
+
+def create_ledger_table(cursor: mysql.connector.connect, connection: mysql.connector.connect) -> None:
+    """Creates ledger table if it does not exist"""
+    cursor.execute(f"""
+        CREATE TABLE IF NOT EXISTS {LEDGER_TABLE} (
+            table_name VARCHAR(64) NOT NULL,
+            raw_id BIGINT NOT NULL,
+            db_id BIGINT NOT NULL,
+            fingerprint BIGINT NOT NULL,
+            PRIMARY KEY (table_name, raw_id)
+        )""")
+    connection.commit()
+
+
+def clear_ledger(engine: create_engine) -> None:
+    """
+    Deletes the ledger. It has to be done whenever event, time and price tables are reloaded (or replaced) not by
+    sync, because ids in the ledger point to the rows that are gone. The next sync then reloads the tables and
+    fills the ledger again.
+    """
+    if LEDGER_TABLE in inspect(engine).get_table_names():
+        with engine.begin() as db_connection:
+            db_connection.execute(text(f'DELETE FROM {LEDGER_TABLE}'))
+        instrumentation.add_round_trips()
+        logger.info(f'Deleted {LEDGER_TABLE} table rows')
+
+
+def read_ledger(table_name: str, engine: create_engine) -> pd.DataFrame:
+    """Reads ledger of the table. Returns df with columns 'db_id' and 'fingerprint' indexed by raw id"""
+    ledger = pd.read_sql_query(
+        text(f'select raw_id, db_id, fingerprint from {LEDGER_TABLE} where table_name = :table_name'),
+        engine, params={'table_name': table_name})
+    return ledger.set_index('raw_id')
+
+
+def diff_with_ledger(df: pd.DataFrame, fingerprints: pd.Series, ledger: pd.DataFrame) -> Tuple[
+                     pd.DataFrame, pd.DataFrame, pd.DataFrame]:
+    """
+    Compares cleaned rows with the ledger.
+    Returns:
+        new rows, changed rows (with 'db_id' column) and ledger of vanished rows
+    """
+    known = df['id'].isin(ledger.index)
+    new_df = df[~known]
+
+    known_df = df[known]
+    known_ledger = ledger.loc[known_df['id']]
+    changed = known_ledger['fingerprint'].values != fingerprints[known].values
+    changed_df = known_df[changed].assign(db_id=known_ledger['db_id'].values[changed])
+
+    vanished_ledger = ledger[~ledger.index.isin(df['id'])]
+    return new_df, changed_df, vanished_ledger
+
+
+def update_rows(df: pd.DataFrame, table_name: str, cursor: mysql.connector.connect,
+                connection: mysql.connector.connect, batch_size: int = 5000) -> None:
+    """Updates rows in table. df has 'db_id' column with ids of rows to update and columns to set"""
+    columns = [col for col in df.columns if col != 'db_id']
+    assignments = ', '.join(f'{col} = %s' for col in columns)
+    rows = to_db_rows(df[columns + ['db_id']])
+    for start in range(0, len(rows), batch_size):
+        cursor.executemany(f'UPDATE {table_name} SET {assignments} WHERE id = %s', rows[start:start + batch_size])
+        instrumentation.add_round_trips()
+    connection.commit()
+    logger.info(f'Updated {len(rows)} {table_name} table rows')
+
+
+class TableSync:
+    """
+    Sync plan of one table. It is computed for all tables first, because vanished rows have to be deleted
+    from child tables before parent ones, while new rows have to be inserted into parent tables first.
+    """
+
+    def __init__(self, table_name: str, df: pd.DataFrame, engine: create_engine):
+        self.table_name = table_name
+        df = df.reset_index(drop=True)
+        self.fingerprints = fingerprint_rows(df, [col for col in df.columns if col != 'id'])
+        self.ledger = read_ledger(table_name, engine)
+        self.new_df, self.changed_df, self.vanished_ledger = diff_with_ledger(df, self.fingerprints, self.ledger)
+        logger.info(f'Table {table_name}: {len(self.new_df)} new, {len(self.changed_df)} changed, '
+                    f'{len(self.vanished_ledger)} vanished rows')
+
+    def delete_vanished(self, cursor: mysql.connector.connect, connection: mysql.connector.connect) -> None:
+        """Deletes vanished rows from table and ledger"""
+        delete_rows_by_id(cursor, connection, self.table_name, self.vanished_ledger['db_id'].tolist())
+        delete_rows_by_id(cursor, connection, LEDGER_TABLE, self.vanished_ledger.index.tolist(),
+                          id_column='raw_id', where='and table_name = %s', params=(self.table_name,))
+
+    def add_to_ledger(self, df: pd.DataFrame, db_ids: pd.Series, engine: create_engine) -> None:
+        """Adds ledger entries of rows of df pushed with given ids (Series indexed by raw ids in the order of df)"""
+        new_ledger = pd.DataFrame({'table_name': self.table_name,
+                                   'raw_id': db_ids.index.values,
+                                   'db_id': db_ids.values,
+                                   'fingerprint': self.fingerprints[df.index].values})
+        add_data(df=new_ledger, sql_table_name=LEDGER_TABLE, connection=engine, batch_size=5000,
+                 return_mapping=False)
+
+    def find_unledgered(self, new_df: pd.DataFrame, engine: create_engine) -> pd.Series:
+        """
+        Finds new rows that are already in the table, because previous sync failed after they were inserted and
+        before their ledger entries were written.
+        Returns:
+            Ids in DB indexed by raw ids
+        """
+        check_raw_id_column(self.table_name, engine)
+        ids_db = read_ids_by_raw_ids(new_df['id'], self.table_name, engine)
+        return ids_db.groupby('raw_id')['id'].max().rename('id_db').rename_axis('id')
+
+    def write(self, new_df: pd.DataFrame, changed_df: pd.DataFrame, engine: create_engine,
+              cursor: mysql.connector.connect, connection: mysql.connector.connect,
+              loader: str = 'to_sql') -> pd.Series:
+        """
+        Inserts new rows and updates changed ones. Given dfs are ready to be pushed (foreign keys are remapped).
+        New rows that are already in the table (see find_unledgered) are added to the ledger and updated.
+        Returns:
+            Mapping from raw ids to ids in processing DB for all the rows of the table
+        """
+        mapping = self.ledger['db_id'].drop(self.vanished_ledger.index).rename('id_db').rename_axis('id')
+        if len(new_df):
+            unledgered = self.find_unledgered(new_df, engine)
+            if len(unledgered):
+                logger.warning(f'{len(unledgered)} {self.table_name} rows were pushed by a failed sync and are '
+                               f'missing in the ledger, they are updated instead of inserted')
+                is_unledgered = new_df['id'].isin(unledgered.index).values
+                unledgered_df = new_df[is_unledgered]
+                unledgered_ids = unledgered.reindex(unledgered_df['id'].values)
+                self.add_to_ledger(unledgered_df, unledgered_ids, engine)
+                mapping = pd.concat([mapping, unledgered_ids])
+                changed_df = pd.concat([changed_df, unledgered_df.assign(db_id=unledgered_ids.values)])
+                new_df = new_df[~is_unledgered]
+
+        if len(new_df):
+            new_mapping = add_data(df=new_df, sql_table_name=self.table_name, connection=engine,
+                                   batch_size=5000, return_mapping=True, loader=loader)
+            mapping = pd.concat([mapping, new_mapping])
+            self.add_to_ledger(new_df, new_mapping, engine)
+
+        if len(changed_df):
+            update_rows(changed_df.drop(columns=['id']), self.table_name, cursor, connection)
+            ledger_rows = pd.DataFrame({'fingerprint': self.fingerprints[changed_df.index].values,
+                                        'table_name': self.table_name,
+                                        'raw_id': changed_df['id'].values})
+            cursor.executemany(f'UPDATE {LEDGER_TABLE} SET fingerprint = %s WHERE table_name = %s AND raw_id = %s',
+                               to_db_rows(ledger_rows))
+            connection.commit()
+        return mapping
+
+
+def sync_clean_data(event_df: pd.DataFrame, time_df: pd.DataFrame, price_df: pd.DataFrame,
+                    loaders: Optional[dict] = None) -> pd.Series:
+    """
+    Syncs clean data with processing DB. Tables, filled by process_tags, have to be cleared before it is called,
+    because they reference events that may be deleted.
+    Params:
+        event_df: processed data from raw_event table in Scraping DB
+        time_df: processed data from raw_time table in Scraping DB
+        price_df: processed data from raw_price table in Scraping DB
+        loaders: mapping from table name to loader used to insert new rows (see add_data)
+    Returns:
+        Mapping from old ids from scraping event table to new ids from processed event table
+    """
+    engine = connect_to_mpdprocessing_new_engine()
+    connection = connect_to_mpdprocessing_new()
+    cursor = connection.cursor()
+    create_ledger_table(cursor, connection)
+    loaders = loaders or {}
+
+    event_df = event_df.drop(columns=['tags'])
+
+    # Without ledger rows can't be matched, so previously pushed data is removed and fully reloaded
+    if read_ledger('event', engine).empty:
+        for table_name in ['price', 'time', 'event']:
+            delete_data_in_table(cursor, connection, table_name)
+
+    event_sync = TableSync('event', event_df, engine)
+    time_sync = TableSync('time', time_df, engine)
+    price_sync = TableSync('price', price_df, engine)
+
+    # Delete vanished rows starting from child tables
+    for table_sync in [price_sync, time_sync, event_sync]:
+        table_sync.delete_vanished(cursor, connection)
+
+    # Push event data
+    event2time = event_sync.write(event_sync.new_df, event_sync.changed_df, engine, cursor, connection,
+                                  loader=loaders.get('event', 'to_sql'))
+
+    # Push time data
+    new_time_df, changed_time_df = [
+        format_time_columns(df.assign(raw_event_id=translate_ids(df['raw_event_id'], event2time, 'event ids')))
+        for df in [time_sync.new_df, time_sync.changed_df]]
+    time2price = time_sync.write(new_time_df, changed_time_df, engine, cursor, connection,
+                                 loader=loaders.get('time', 'to_sql'))
+
+    # Push price data
+    new_price_df, changed_price_df = [
+        df.assign(raw_time_id=translate_ids(df['raw_time_id'], time2price, 'time ids')).rename(
+            columns={'raw_time_id': 'time_id'})
+        for df in [price_sync.new_df, price_sync.changed_df]]
+    price_sync.write(new_price_df, changed_price_df, engine, cursor, connection, loader=loaders.get('price', 'to_sql'))
+
+    cursor.close()
+    return event2time
@@ -0,0 +1,227 @@
+"""
+Module is used to generate synthetic scraping DB to benchmark the pipeline without live MySQL.
+raw_event, raw_time and raw_price tables are written to SQLite file with the same columns as in scraping DB.
+Events have skewed source sizes, exact duplicates inside and between sources, html descriptions, canceled and
+virtual events, and tags with Zipf distribution. Times have out of window and unparsable dates, and some times of
+virtual events can have location if mixed_rate is given.
+Empty tables of processing DB can be created in another SQLite file to push the cleaned data to.
+"""
+
+from migrate_raw_id import RAW_ID_TABLES
+from typing import Iterator
+import numpy as np
+import pandas as pd
+import datetime
+import sqlite3
+
+SYLLABLES = np.array(['ja', 'zz', 'ni', 'ght', 'fes', 'ti', 'val', 'con', 'cert', 'yo', 'ga', 'ki', 'ds', 'ar',
+                      'sho', 'wi', 'ne', 'ta', 'be', 'er', 'mar', 'ket', 'co', 'me', 'dy', 'mu', 'sic', 'da',
+                      'par', 'ty'])
+
+RAW_TABLES = {
+    'raw_event': 'id INTEGER PRIMARY KEY, url TEXT, title TEXT, image_url TEXT, description TEXT, source TEXT, '
+                 'is_affiliate INTEGER, tags TEXT',
+    'raw_time': 'id INTEGER PRIMARY KEY, raw_event_id INTEGER, start_time TEXT, end_time TEXT, location TEXT, '
+                'processed_street_address TEXT, postal_code TEXT, longitude REAL, latitude REAL, state TEXT',
+    'raw_price': 'id INTEGER PRIMARY KEY, raw_time_id INTEGER, price REAL, currency TEXT',
+}
+
+RAW_INDEXES = {'raw_event': 'source', 'raw_time': 'raw_event_id', 'raw_price': 'raw_time_id'}
+
+PROCESSING_TABLES = {
+    'event': 'raw_id, url, title, image_url, description, source, is_affiliate, title_modified, is_virtual',
+    'time': 'raw_id, event_id, start_time, end_time, location, processed_street_address, postal_code, longitude, '
+            'latitude, state',
+    'price': 'raw_id, time_id, price, currency',
+    'tag': 'raw_id, name',
+    'subcategory': 'raw_id, name',
+    'category': 'raw_id, name',
+    'tag__event': 'event_id, tag_id',
+    'subcategory__tag': 'tag_id, subcategory_id',
+    'category__subcategory': 'subcategory_id, category_id',
+}
+
+
+def generate_words(n_words: int, rng: np.random.RandomState) -> np.ndarray:
+    """Generates vocabulary of unique pseudo-words"""
+    words = rng.choice(SYLLABLES, size=(n_words * 2, 4))
+    lengths = rng.randint(2, 5, size=n_words * 2)
+    return pd.unique(np.array([''.join(word[:length]) for word, length in zip(words, lengths)]))[:n_words]
+
+
+def join_words(words: np.ndarray, lengths: np.ndarray) -> list:
+    """Joins first lengths[i] words of every row with spaces"""
+    return [' '.join(row[:length]) for row, length in zip(words, lengths)]
+
+
+def get_source_sizes(n_events: int, n_sources: int) -> np.ndarray:
+    """Splits events between sources, the size of the source is inversely proportional to its rank"""
+    weights = 1 / np.arange(1, n_sources + 1)
+    sizes = np.floor(weights / weights.sum() * n_events).astype(np.int64)
+    sizes[0] += n_events - sizes.sum()
+    return sizes
+
+
+def generate_events(start_id: int, n_events: int, source_of_event: np.ndarray, affiliate_sources: np.ndarray,
+                    vocabulary: np.ndarray, tag_names: np.ndarray, duplicate_rate: float,
+                    rng: np.random.RandomState) -> pd.DataFrame:
+    """Generates chunk of raw events. Duplicates copy title, url and description of an earlier event of the chunk"""
+    title_lengths = rng.randint(3, 8, size=n_events)
+    titles = np.array(join_words(vocabulary[rng.randint(0, len(vocabulary), size=(n_events, 7))], title_lengths),
+                      dtype=object)
+    kind = rng.random_sample(n_events)
+    titles[kind < 0.01] += ' - Cancelled'
+    titles[(kind >= 0.01) & (kind < 0.03)] += ' (Virtual)'
+    titles[(kind >= 0.03) & (kind < 0.04)] = 'Live Stream: ' + titles[(kind >= 0.03) & (kind < 0.04)]
+
+    ids = np.arange(start_id, start_id + n_events)
+    urls = np.array([f'https://example.com/events/{event_id}' for event_id in ids], dtype=object)
+
+    descriptions = np.array(join_words(vocabulary[rng.randint(0, len(vocabulary), size=(n_events, 20))],
+                                       rng.randint(5, 21, size=n_events)), dtype=object)
+    markup = rng.random_sample(n_events)
+    descriptions[markup < 0.3] = [f'{desc} &amp; more at <a href="{url}">{url}</a>'
+                                  for desc, url in zip(descriptions[markup < 0.3], urls[markup < 0.3])]
+    descriptions[(markup >= 0.3) & (markup < 0.4)] += ' Tickets &gt; $10 &quot;early bird&quot;'
+    descriptions[markup > 0.95] = None
+
+    # Tag ranks have Zipf distribution, so a few tags are very frequent and most of them are rare
+    n_tags = rng.randint(0, 6, size=n_events)
+    tag_ranks = np.minimum(rng.zipf(1.3, size=(n_events, 5)), len(tag_names)) - 1
+    tags = np.array([','.join(row[:n]) for row, n in zip(tag_names[tag_ranks], n_tags)], dtype=object)
+    tags[n_tags == 0] = None
+
+    # Duplicates of earlier events, in the same or another source
+    duplicate = np.flatnonzero(rng.random_sample(n_events) < duplicate_rate)
+    duplicate = duplicate[duplicate > 0]
+    original = (rng.random_sample(len(duplicate)) * duplicate).astype(np.int64)
+    for column in [titles, urls, descriptions, tags]:
+        column[duplicate] = column[original]
+
+    sources = np.array([f'source_{source}' for source in range(source_of_event.max() + 1)])
+    return pd.DataFrame({
+        'id': ids, 'url': urls, 'title': titles,
+        'image_url': [f'https://example.com/images/{event_id}.jpg' for event_id in ids],
+        'description': descriptions, 'source': sources[source_of_event],
+        'is_affiliate': affiliate_sources[source_of_event].astype(np.int64), 'tags': tags})
+
+
+def generate_times(start_id: int, event_ids: np.ndarray, times_per_event: float,
+                   rng: np.random.RandomState, mixed_rate: float = 0.0) -> pd.DataFrame:
+    """
+    Generates raw times of events. Some of them are in the past, too far in future or can't be parsed.
+    mixed_rate is the share of times of virtual events that have location anyway
+    """
+    n_times = rng.poisson(times_per_event - 1, size=len(event_ids)) + 1
+    # Virtual events don't have location in any of their times
+    virtual = np.repeat(rng.random_sample(len(event_ids)) < 0.1, n_times)
+    event_ids = np.repeat(event_ids, n_times)
+    n = len(event_ids)
+
+    today = np.datetime64(datetime.date.today(), 's')
+    start = today + rng.randint(-60 * 86400, 1600 * 86400, size=n).astype('timedelta64[s]')
+    end = start + rng.randint(3600, 6 * 3600, size=n).astype('timedelta64[s]')
+    start_time = np.datetime_as_string(start).astype(object)
+    end_time = np.datetime_as_string(end).astype(object)
+    start_time[rng.random_sample(n) < 0.01] = 'TBA'
+    end_time[rng.random_sample(n) < 0.05] = None
+
+    venues = rng.randint(0, 5000, size=n)
+    location = np.array([f'Venue {venue}' for venue in venues], dtype=object)
+    if mixed_rate > 0:
+        virtual &= rng.random_sample(n) >= mixed_rate
+    location[virtual] = None
+
+    times = pd.DataFrame({
+        'id': np.arange(start_id, start_id + n), 'raw_event_id': event_ids,
+        'start_time': start_time, 'end_time': end_time, 'location': location,
+        'processed_street_address': [f'{venue} Main St' for venue in venues],
+        'postal_code': (10000 + venues).astype(str),
+        'longitude': np.round(-74 + venues / 5000, 6), 'latitude': np.round(40 + venues / 5000, 6),
+        'state': np.where(venues % 2 == 0, 'NY', 'NJ')})
+    times.loc[virtual, ['processed_street_address', 'postal_code', 'longitude', 'latitude', 'state']] = None
+    return times
+
+
+def generate_prices(start_id: int, time_ids: np.ndarray, rng: np.random.RandomState) -> pd.DataFrame:
+    """Generates 0-2 raw prices for every time"""
+    time_ids = np.repeat(time_ids, rng.randint(0, 3, size=len(time_ids)))
+    return pd.DataFrame({'id': np.arange(start_id, start_id + len(time_ids)), 'raw_time_id': time_ids,
+                         'price': np.round(rng.uniform(0, 200, size=len(time_ids)), 2), 'currency': 'USD'})
+
+
+def generate_chunks(n_events: int, n_sources: int = 50, affiliate_share: float = 0.2, duplicate_rate: float = 0.2,
+                    times_per_event: float = 2.0, mixed_rate: float = 0.0, n_tags: int = 5000,
+                    chunk_size: int = 100000, seed: int = 0) -> Iterator[tuple]:
+    """
+    Generates raw data chunk by chunk, so memory does not grow with the number of events.
+    Returns:
+        Iterator over (event_df, time_df, price_df) chunks
+    """
+    rng = np.random.RandomState(seed)
+    vocabulary = generate_words(20000, rng)
+    tag_names = generate_words(n_tags, rng)
+    # A few tags are numbers, they are filtered out by process_tags
+    numeric = rng.random_sample(len(tag_names)) < 0.02
+    tag_names[numeric] = rng.randint(0, 1000, size=numeric.sum()).astype(str)
+    affiliate_sources = rng.random_sample(n_sources) < affiliate_share
+    source_of_event = np.repeat(np.arange(n_sources), get_source_sizes(n_events, n_sources))
+
+    time_id, price_id = 1, 1
+    for start in range(0, n_events, chunk_size):
+        end = min(start + chunk_size, n_events)
+        event_df = generate_events(start + 1, end - start, source_of_event[start:end], affiliate_sources,
+                                   vocabulary, tag_names, duplicate_rate, rng)
+        time_df = generate_times(time_id, event_df['id'].values, times_per_event, rng, mixed_rate)
+        price_df = generate_prices(price_id, time_df['id'].values, rng)
+        time_id += time_df.shape[0]
+        price_id += price_df.shape[0]
+        yield event_df, time_df, price_df
+
+
+def write_table(connection: sqlite3.Connection, table_name: str, df: pd.DataFrame) -> None:
+    """Inserts rows of df to the table"""
+    placeholders = ', '.join('?' for _ in df.columns)
+    rows = df.astype(object).where(df.notna(), None).itertuples(index=False, name=None)
+    connection.executemany(f'INSERT INTO {table_name} ({", ".join(df.columns)}) VALUES ({placeholders})', rows)
+
+
+def generate_scraping_db(path: str, n_events: int, **params) -> dict:
+    """
+    Writes synthetic raw_event, raw_time and raw_price tables to SQLite file. Existing tables are replaced.
+    params are passed to generate_chunks.
+    Returns:
+        Number of rows in every table
+    """
+    connection = sqlite3.connect(path)
+    for table_name, columns in RAW_TABLES.items():
+        connection.execute(f'DROP TABLE IF EXISTS {table_name}')
+        connection.execute(f'CREATE TABLE {table_name} ({columns})')
+
+    counts = dict.fromkeys(RAW_TABLES, 0)
+    for chunks in generate_chunks(n_events, **params):
+        for table_name, df in zip(RAW_TABLES, chunks):
+            write_table(connection, table_name, df)
+            counts[table_name] += df.shape[0]
+        connection.commit()
+
+    for table_name, column in RAW_INDEXES.items():
+        connection.execute(f'CREATE INDEX ix_{table_name}_{column} ON {table_name} ({column})')
+    connection.commit()
+    connection.close()
+    return counts
+
+
+def create_processing_db(path: str) -> None:
+    """
+    Creates empty tables of processing DB in SQLite file. Existing tables are replaced. Tables pushed with id mapping
+    have indexed 'raw_id' column, as after migrate_raw_id.py.
+    """
+    connection = sqlite3.connect(path)
+    for table_name, columns in PROCESSING_TABLES.items():
+        connection.execute(f'DROP TABLE IF EXISTS {table_name}')
+        connection.execute(f'CREATE TABLE {table_name} (id INTEGER PRIMARY KEY AUTOINCREMENT, {columns})')
+    for table_name in RAW_ID_TABLES:
+        connection.execute(f'CREATE INDEX ix_{table_name}_raw_id ON {table_name} (raw_id)')
+    connection.commit()
+    connection.close()
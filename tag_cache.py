@@ -0,0 +1,74 @@
+"""
+Module contains on-disk cache of tag classification results.
+Most of the tags are the same from one run to another, so only unseen tags have to be sent to the classifier.
+Results are stored in SQLite keyed by normalized tag and classifier version, so changing the classifier
+invalidates the cache. Entries older than ttl are classified again.
+"""
+
+from typing import Optional
+import sqlite3
+import time
+
+SECONDS_IN_DAY = 24 * 60 * 60
+
+
+def normalize_tag(tag: str) -> str:
+    """Normalizes tag to use it as a cache key"""
+    return tag.strip().lower()
+
+
+class TagCache:
+    """
+    SQLite cache of tag categories. Tags that couldn't be classified are cached too, to not query them every run.
+    Number of hits and misses is counted.
+    """
+
+    def __init__(self, path: str = 'tag_cache.sqlite', version: str = '', ttl_days: Optional[float] = 30):
+        self.connection = sqlite3.connect(path)
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS tag_category (
+                tag TEXT NOT NULL,
+                version TEXT NOT NULL,
+                category TEXT,
+                classified_at REAL NOT NULL,
+                PRIMARY KEY (tag, version)
+            )""")
+        self.connection.commit()
+        self.version = version
+        self.ttl = ttl_days * SECONDS_IN_DAY if ttl_days is not None else None
+        self.hits = 0
+        self.misses = 0
+
+    def get_many(self, tags: list, batch_size: int = 500) -> dict:
+        """
+        Returns mapping from tag to cached category for the tags found in the cache. Tags are looked up by IN lists
+        of batch_size tags.
+        """
+        min_classified_at = time.time() - self.ttl if self.ttl is not None else 0
+        keys = list(dict.fromkeys(normalize_tag(tag) for tag in tags))
+        cached = {}
+        for start in range(0, len(keys), batch_size):
+            batch = keys[start:start + batch_size]
+            cached.update(self.connection.execute(
+                f'SELECT tag, category FROM tag_category WHERE version = ? AND classified_at >= ? '
+                f'AND tag IN ({", ".join("?" * len(batch))})',
+                (self.version, min_classified_at, *batch)).fetchall())
+        found = {}
+        for tag in tags:
+            if normalize_tag(tag) in cached:
+                self.hits += 1
+                found[tag] = cached[normalize_tag(tag)]
+            else:
+                self.misses += 1
+        return found
+
+    def set(self, tag: str, category: Optional[str]) -> None:
+        """Saves category of the tag. It is committed at once, so finished work is not lost on failure"""
+        self.connection.execute(
+            'INSERT OR REPLACE INTO tag_category (tag, version, category, classified_at) VALUES (?, ?, ?, ?)',
+            (normalize_tag(tag), self.version, category, time.time()))
+        self.connection.commit()
+
+    def close(self) -> None:
+        """Closes connection to the cache"""
+        self.connection.close()
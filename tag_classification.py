@@ -0,0 +1,141 @@
+"""
+Module contains classifiers of tags. Classifier takes a tag and returns the category path for it,
+e.g. '/Arts & Entertainment/Music & Audio', or None if the tag can't be classified.
+Google language API is used in production. Stub classifier stands in for it in tests and benchmarks.
+"""
+
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Callable, Optional
+import instrumentation
+import threading
+import time
+import os
+
+os.environ['GOOGLE_APPLICATION_CREDENTIALS'] = 'Eventmoon-cb642c460e65.json'
+
+
+class GoogleLanguageClassifier:
+    """
+    Classifies tags with Google language API. The tag is repeated several times in the input, because API has
+    a minimum length threshold. One client is used for all requests, it is safe to share it between threads.
+    """
+    version = 'google-language-v1'
+
+    def __init__(self, repeat: int = 30):
+        # Imported here to let other classifiers work without google-cloud-language installed
+        from google.cloud import language
+        self.language = language
+        self.client = language.LanguageServiceClient()
+        self.repeat = repeat
+
+    def classify(self, tag: str) -> Optional[str]:
+        """Classify the tag into category"""
+        document = self.language.types.Document(
+            content=' '.join([tag for _ in range(self.repeat)]),
+            type=self.language.enums.Document.Type.PLAIN_TEXT)
+        response = self.client.classify_text(document)
+        categories = response.categories
+        for category in categories:
+            return category.name
+        return None
+
+
+class StubClassifier:
+    """
+    Classifies tags using given mapping from tag to category. Tags missing in the mapping are not classified.
+    Latency can be added to every request to emulate API.
+    """
+    version = 'stub'
+
+    def __init__(self, categories: dict, latency: float = 0.0):
+        self.categories = categories
+        self.latency = latency
+        self.calls = 0
+        self.lock = threading.Lock()
+
+    def classify(self, tag: str) -> Optional[str]:
+        """Classify the tag into category"""
+        with self.lock:
+            self.calls += 1
+        if self.latency:
+            time.sleep(self.latency)
+        return self.categories.get(tag)
+
+
+class TokenBucket:
+    """Limits the rate of requests made from several threads. Up to capacity requests can be made at once."""
+
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self) -> None:
+        """Waits until a request can be made"""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+                self.updated_at = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+def classify_with_retries(classifier, tag: str, rate_limiter: Optional[TokenBucket] = None, retries: int = 3,
+                          backoff: float = 1.0) -> Optional[str]:
+    """Classifies the tag. Failed requests are retried with exponential backoff."""
+    for attempt in range(retries + 1):
+        if rate_limiter is not None:
+            rate_limiter.acquire()
+        instrumentation.add_round_trips()
+        try:
+            return classifier.classify(tag)
+        except Exception:
+            if attempt == retries:
+                raise
+            time.sleep(backoff * 2 ** attempt)
+
+
+def classify_concurrently(tags: list, classifier, max_workers: int = 8, requests_per_second: Optional[float] = None,
+                          retries: int = 3, backoff: float = 1.0,
+                          on_result: Optional[Callable[[str, Optional[str]], None]] = None) -> dict:
+    """
+    Classifies tags in several threads using the same classifier.
+    Params:
+        tags: tags to classify
+        classifier: object with classify(tag) method
+        max_workers: maximum number of requests made at the same time
+        requests_per_second: maximum rate of requests, not limited if None
+        retries: number of retries of a failed request
+        backoff: delay before the first retry in seconds, it is doubled for every next retry
+        on_result: function called with tag and its category as soon as the tag is classified. It is called in
+            the calling thread and is used to save finished work.
+    Returns:
+        Mapping from tag to category. If some tags fail after all retries, error is raised after the rest of
+        the tags are classified.
+    """
+    rate_limiter = TokenBucket(requests_per_second) if requests_per_second else None
+    categories = {}
+    failed = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        future2tag = {executor.submit(classify_with_retries, classifier, tag, rate_limiter, retries, backoff): tag
+                      for tag in tags}
+        for future in as_completed(future2tag):
+            tag = future2tag[future]
+            try:
+                categories[tag] = future.result()
+            except Exception as error:
+                failed[tag] = error
+                continue
+            if on_result is not None:
+                on_result(tag, categories[tag])
+
+    if failed:
+        tag, error = next(iter(failed.items()))
+        raise RuntimeError(f'Failed to classify {len(failed)} tags, e.g. {tag!r}: {error!r}') from error
+    return categories
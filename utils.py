@@ -2,25 +2,57 @@
 Module contains general functions.
 """
 
-from datetime import datetime as dt
+from sqlalchemy import bindparam, create_engine, inspect, text
+from functools import lru_cache
+from typing import Callable, Optional, Tuple
 from nltk.stem import PorterStemmer
 from nltk.corpus import stopwords
+from bulk_load import LOADERS, load_data_infile, insert_many
 from bs4 import BeautifulSoup
-import mysql.connector
+import instrumentation
 import pandas as pd
+import logging
 import string
+import math
+import re
+
+logger = logging.getLogger(__name__)
+
+
+PUNCTUATION_TABLE = str.maketrans('', '', string.punctuation)
+STEMMER = PorterStemmer()
+ANCHOR_TAGS = re.compile(r'<a\b[^>]*>|</a\s*>', re.IGNORECASE)
+# Symbols left after anchors are removed that need HTML parser: other markup, entities and control characters,
+# which parser changes or drops
+COMPLEX_MARKUP = re.compile('[<>&\x00-\x08\x0b-\x1f\x7f-\x9f\ud800-\udfff\ufeff\ufffe\uffff]')
+# Parser drops whitespace between some tags
+BLANK_BETWEEN_TAGS = re.compile(r'>\s+<')
+DESCRIPTION_CACHE_SIZE = 2 ** 16
+
+
+@lru_cache(maxsize=None)
+def get_stop_words() -> frozenset:
+    """Loads english stopwords once"""
+    return frozenset(stopwords.words('english'))
+
+
+@lru_cache(maxsize=None)
+def stem_word(word: str) -> str:
+    """Stems a single word. Results are cached, because the vocabulary of titles is small"""
+    return STEMMER.stem(word)
 
 
 def remove_punctuations(input_str: str) -> str:
     """Removes punctuations from a string"""
-    exclude = set(string.punctuation)
-    return ''.join(ch for ch in input_str if ch not in exclude)
+    return input_str.translate(PUNCTUATION_TABLE)
 
 
 def remove_stopwords(input_str: str) -> str:
     """Removes stopwords from a string"""
-    stop_words = stopwords.words('english')
+    stop_words = get_stop_words()
     separated_words = input_str.split()
+    if not separated_words:
+        return ''
     percentage = sum(1 for word in separated_words if word in stop_words) / len(separated_words)
     if percentage < 0.6:
         return ' '.join(word for word in separated_words if word not in stop_words)
@@ -30,51 +62,176 @@ def remove_stopwords(input_str: str) -> str:
 
 def imply_stemming(input_str: str) -> str:
     """Stems the string"""
-    stemmer = PorterStemmer()
-    return ' '.join(stemmer.stem(word) for word in input_str.split())
+    return ' '.join(stem_word(word) for word in input_str.split())
+
+
+def normalize_title(title: str) -> str:
+    """Lowers, removes punctuations and stopwords, stems and sorts the words of the title"""
+    title = remove_stopwords(remove_punctuations(title.lower()))
+    return ' '.join(sorted(imply_stemming(title).split()))
+
+
+def normalize_titles(titles: pd.Series) -> pd.Series:
+    """
+    Normalizes a whole series of titles with normalize_title.
+    Every unique title is processed only once and the result is mapped back to the series.
+    """
+    unique_titles = titles.dropna().unique()
+    normalized = pd.Series([normalize_title(title) for title in unique_titles], index=unique_titles)
+    return titles.map(normalized)
 
 
-def str2datetime(s: str) -> dt.strptime:
-    """Converts string to datetime object"""
-    try:
-        return dt.strptime(s, '%Y-%m-%dT%H:%M:%S')
-    except:
-        return None
+def parse_datetimes(values: pd.Series, datetime_format: str = '%Y-%m-%dT%H:%M:%S') -> Tuple[pd.Series, int]:
+    """
+    Converts strings to datetimes. Values that don't match the format become NaT.
+    Returns:
+        Parsed datetimes and number of values that failed to parse
+    """
+    parsed = pd.to_datetime(values, format=datetime_format, errors='coerce')
+    return parsed, int((parsed.isna() & values.notna()).sum())
 
 
-def datetime2date(s: dt.strptime):
-    """Parses date from datetime object"""
-    try:
-        return s.date()
-    except:
-        return s
+def format_datetimes(values: pd.Series, datetime_format: str = '%Y-%m-%d %H:%M:%S') -> pd.Series:
+    """Converts datetimes to strings. Missing values become None"""
+    return values.dt.strftime(datetime_format).astype(object).where(values.notna(), None)
 
 
+@lru_cache(maxsize=DESCRIPTION_CACHE_SIZE)
 def remove_html_tag(desc: str) -> str:
-    """Removes html tags from string"""
+    """
+    Removes html tags from string. If there are only anchors, they are removed by regex, otherwise the string is
+    parsed with lxml. Result is the same in both cases. Results are cached, because descriptions repeat.
+    """
     if desc and '<a href' in desc:
-        return BeautifulSoup(desc).text.strip()
+        text = ANCHOR_TAGS.sub('', desc)
+        if COMPLEX_MARKUP.search(text) is None and BLANK_BETWEEN_TAGS.search(desc) is None:
+            return text.strip()
+        return BeautifulSoup(desc, 'lxml').text.strip()
     return desc
 
 
-def add_data(df: pd.DataFrame, sql_table_name: str, connection: mysql.connector.connect, batch_size: int = 5000,
-             return_mapping: bool = True) -> dict:
+def map_unique(values: pd.Series, function: Callable) -> pd.Series:
+    """Applies function to every distinct value once. Missing values are kept as they are"""
+    uniques = values.dropna().unique()
+    mapped = values.map(dict(zip(uniques, map(function, uniques))))
+    return mapped.where(values.notna(), values)
+
+
+class MissingRawIdColumnError(RuntimeError):
+    """Raised when the table pushed with id mapping has no 'raw_id' column"""
+
+    def __init__(self, sql_table_name: str):
+        super().__init__(f"Table {sql_table_name} has no 'raw_id' column, run 'python migrate_raw_id.py' to add it")
+
+
+def check_raw_id_column(sql_table_name: str, connection: create_engine) -> None:
+    """
+    Checks that the table has 'raw_id' column, which keeps the id the row had before it was pushed, so new ids can
+    be resolved after the insert. The column is added by migrate_raw_id.py.
+    """
+    columns = [column['name'] for column in inspect(connection).get_columns(sql_table_name)]
+    instrumentation.add_round_trips()
+    if 'raw_id' not in columns:
+        raise MissingRawIdColumnError(sql_table_name)
+
+
+def read_ids_by_raw_ids(raw_ids, sql_table_name: str, connection: create_engine,
+                        batch_size: int = 10000) -> pd.DataFrame:
+    """
+    Reads ids of the rows with given raw ids. Only these rows are read: raw ids are looked up in the index of
+    raw_id by IN lists of batch_size ids.
+    Returns:
+        df with columns 'raw_id' and 'id'
+    """
+    query = text(f'select raw_id, id from {sql_table_name} where raw_id in :raw_ids').bindparams(
+        bindparam('raw_ids', expanding=True))
+    raw_ids = pd.unique(pd.Series(raw_ids).values)
+    batches = [pd.read_sql_query(query, connection,
+                                 params={'raw_ids': [int(raw_id) for raw_id in raw_ids[start:start + batch_size]]})
+               for start in range(0, len(raw_ids), batch_size)]
+    instrumentation.add_round_trips(len(batches))
+    return pd.concat(batches) if batches else pd.DataFrame({'raw_id': [], 'id': []}, dtype='int64')
+
+
+def get_id_mapping(raw_ids: pd.Series, sql_table_name: str, connection: create_engine) -> pd.Series:
+    """
+    Resolves ids in DB for rows pushed with given raw ids (see read_ids_by_raw_ids). If several rows have the same
+    raw id (e.g. row was pushed by previous run), the latest one is taken.
+    Returns:
+        Series with ids in DB indexed by raw ids in the order of given raw ids
+    """
+    ids_db = read_ids_by_raw_ids(raw_ids, sql_table_name, connection)
+    ids_db = ids_db.groupby('raw_id')['id'].max()
+    mapping = ids_db.reindex(raw_ids.values)
+    if mapping.isna().any():
+        raise ValueError(f'{mapping.isna().sum()} rows pushed to {sql_table_name} were not found in DB')
+    return pd.Series(mapping.values.astype('int64'), index=pd.Index(raw_ids.values, name='id'), name='id_db')
+
+
+def add_data(df: pd.DataFrame, sql_table_name: str, connection: create_engine, batch_size: int = 5000,
+             return_mapping: bool = True, loader: str = 'to_sql') -> Optional[pd.Series]:
     """
     Pushes given df to DB and returns id mapping. When data is added to DB new ids are generated in DB.
     Thus, mapping is returned to latter use it to create connections between 2 tables.
+    Ids of df are pushed to 'raw_id' column (see migrate_raw_id.py), then new ids are resolved by them. Mapping is
+    returned as Series with ids in DB indexed by ids of df. MissingRawIdColumnError is raised before the push if the
+    table has no 'raw_id' column.
+    loader is one of 'to_sql', 'load_data' (LOAD DATA LOCAL INFILE) and 'executemany' (multi-row inserts).
     """
-    if return_mapping:
-        ids = df[['id']]
-        df = df.drop(columns=['id'])
-
-    df.to_sql(sql_table_name, connection, if_exists='append', index=False, chunksize=batch_size)
-    print(f'Added table: {sql_table_name}')
+    if loader not in LOADERS:
+        raise ValueError(f'Unknown loader {loader!r}, expected one of {LOADERS}')
+
+    with instrumentation.stage('add_data', table=sql_table_name, loader=loader) as metrics:
+        metrics.rows_in = df.shape[0]
+        if return_mapping:
+            check_raw_id_column(sql_table_name, connection)
+            df = df.rename(columns={'id': 'raw_id'})
+
+        if loader == 'load_data':
+            load_data_infile(df, sql_table_name, connection)
+            instrumentation.add_round_trips()
+        elif loader == 'executemany':
+            insert_many(df, sql_table_name, connection, batch_size=batch_size)
+            instrumentation.add_round_trips(math.ceil(df.shape[0] / batch_size))
+        else:
+            df.to_sql(sql_table_name, connection, if_exists='append', index=False, chunksize=batch_size)
+            instrumentation.add_round_trips(math.ceil(df.shape[0] / batch_size))
+        metrics.rows_out = df.shape[0]
+        logger.info(f'Added table: {sql_table_name}')
+
+        if not return_mapping:
+            return None
+        if df.shape[0] == 0:
+            return pd.Series([], index=pd.Index([], name='id'), name='id_db', dtype='int64')
+        return get_id_mapping(df['raw_id'], sql_table_name, connection)
+
+
+class UnmappedIdsError(KeyError):
+    """Raised when some ids are missing in the id mapping"""
+
+    def __init__(self, name: str, missing: list):
+        self.missing = missing
+        super().__init__(f'{len(missing)} {name} are missing in the mapping, e.g. {missing[:10]}')
+
+
+def translate_ids(ids: pd.Series, mapping: pd.Series, name: str = 'ids') -> pd.Series:
+    """
+    Translates ids using mapping (Series with new ids indexed by old ids, as returned by add_data).
+    Ids are looked up in the hash index of the mapping at once.
+    Raises UnmappedIdsError with the list of missing ids if some ids are not in the mapping.
+    """
+    if not mapping.index.is_unique:
+        raise ValueError(f'Mapping of {name} has duplicated keys')
+    positions = mapping.index.get_indexer(ids.values)
+    missing = positions < 0
+    if missing.any():
+        raise UnmappedIdsError(name, pd.unique(ids.values[missing]).tolist())
+    return pd.Series(mapping.values[positions], index=ids.index, name=ids.name)
 
-    if return_mapping:
-        last_id = pd.read_sql_query(f'select max(id) + 1 from {sql_table_name}', connection).iloc[0, 0]
-        ids_added = list(range(last_id - len(df), last_id))
 
-        ids['id_db'] = ids_added
-        mapping = ids[['id', 'id_db']].set_index('id')['id_db'].to_dict()
+def fingerprint_rows(df: pd.DataFrame, columns: list) -> pd.Series:
+    """
+    Computes 64-bit hash of given columns for every row. Hash is signed to fit into BIGINT column in DB.
+    """
+    return pd.util.hash_pandas_object(df[columns], index=False).astype('int64')
 
-        return mapping